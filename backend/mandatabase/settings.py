@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/4.2/ref/settings/
 
 import configparser
 import os
+
 # from osgeo import gdal
 from pathlib import Path
 
@@ -168,6 +169,11 @@ CORS_ALLOW_HEADERS = [
     "Content-Type",
     "X-CSRFToken",
 ]
+
+CORS_EXPOSE_HEADERS = [
+    "X-Decimated",
+    "X-Total-Points",
+]
 #
 ROOT_URLCONF = "mandatabase.urls"
 TEMPLATES = [
@@ -203,6 +209,54 @@ DATABASES = {
     }
 }
 
+# Generated download archives are cached on disk, keyed by the normalized
+# request and the current ingest generation (see maritimeapp/cache.py).
+DOWNLOAD_CACHE_DIR = os.getenv(
+    "DJANGO_DOWNLOAD_CACHE_DIR", os.path.join(BASE_DIR, "download_cache")
+)
+DOWNLOAD_CACHE_BYTES = config.getint("cache", "DOWNLOAD_CACHE_BYTES", fallback=2 << 30)
+
+# Per-cruise CSV fragments written at ingest, served for unfiltered downloads.
+DOWNLOAD_FRAGMENTS_DIR = os.getenv(
+    "DJANGO_DOWNLOAD_FRAGMENTS_DIR", os.path.join(BASE_DIR, "download_fragments")
+)
+
+# Archives built by the download_worker command, and how long they are kept.
+DOWNLOAD_JOBS_DIR = os.getenv(
+    "DJANGO_DOWNLOAD_JOBS_DIR", os.path.join(BASE_DIR, "download_jobs")
+)
+DOWNLOAD_JOB_TTL = config.getint("jobs", "DOWNLOAD_JOB_TTL", fallback=24 * 3600)
+# Seconds a running job may go without a heartbeat from its worker before
+# another worker takes it over.
+DOWNLOAD_JOB_LEASE = config.getint("jobs", "DOWNLOAD_JOB_LEASE", fallback=300)
+
+# Estimated rows above which download_data hands the request to a job
+# instead of streaming it, and above which it refuses it. 0 disables either.
+DOWNLOAD_DEFER_ROWS = config.getint("download", "DOWNLOAD_DEFER_ROWS", fallback=0)
+DOWNLOAD_MAX_ROWS = config.getint("download", "DOWNLOAD_MAX_ROWS", fallback=0)
+# Print the query count and per-stage timings of every download request.
+DOWNLOAD_PROFILE = config.getboolean("download", "DOWNLOAD_PROFILE", fallback=False)
+
+# list_sites and site_measurements responses are cached per process, up to
+# RESULT_CACHE_BYTES of gzipped bodies (see maritimeapp/results.py). Setting
+# RESULT_CACHE_DIR adds a cache shared by every worker.
+RESULT_CACHE_BYTES = config.getint("cache", "RESULT_CACHE_BYTES", fallback=256 << 20)
+RESULT_CACHE_DIR = os.getenv(
+    "DJANGO_RESULT_CACHE_DIR", config.get("cache", "RESULT_CACHE_DIR", fallback="")
+)
+CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+if RESULT_CACHE_DIR:
+    CACHES["results"] = {
+        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+        "LOCATION": RESULT_CACHE_DIR,
+        "TIMEOUT": None,
+        "OPTIONS": {
+            "MAX_ENTRIES": config.getint(
+                "cache", "RESULT_CACHE_ENTRIES", fallback=20000
+            )
+        },
+    }
+
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
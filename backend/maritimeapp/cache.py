@@ -0,0 +1,137 @@
+"""
+On-disk cache of generated download archives.
+
+Entries are keyed by a hash of the normalized download request and live
+under a directory named after the current ingest generation. The ingest
+commands bump the generation when new data lands, which makes every older
+entry unreachable; those directories are removed on the next lookup.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import uuid
+from collections import Counter
+
+from django.conf import settings
+
+GENERATION_FILE = "GENERATION"
+
+# Per process; exposed so the cache can be sized from real traffic.
+stats = Counter()
+
+
+def cache_dir():
+    return settings.DOWNLOAD_CACHE_DIR
+
+
+def ingest_generation():
+    try:
+        with open(os.path.join(cache_dir(), GENERATION_FILE)) as f:
+            return f.read().strip() or "0"
+    except FileNotFoundError:
+        return "0"
+
+
+def bump_ingest_generation():
+    """Called by the ingest commands once new data is in the tables."""
+    os.makedirs(cache_dir(), exist_ok=True)
+    generation = uuid.uuid4().hex
+    with tempfile.NamedTemporaryFile(
+        "w", dir=cache_dir(), delete=False, suffix=".tmp"
+    ) as f:
+        f.write(generation)
+    os.replace(f.name, os.path.join(cache_dir(), GENERATION_FILE))
+    return generation
+
+
+def request_key(params):
+    """
+    Hash of a normalized request. params must already be canonical: sorted
+    lists, defaults folded to None.
+    """
+    encoded = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+def generation_dir():
+    generation = ingest_generation()
+    path = os.path.join(cache_dir(), generation)
+    if not os.path.isdir(path):
+        os.makedirs(path, exist_ok=True)
+        # A new generation has landed: drop the archives of older ones.
+        for name in os.listdir(cache_dir()):
+            old = os.path.join(cache_dir(), name)
+            if name != generation and os.path.isdir(old):
+                shutil.rmtree(old, ignore_errors=True)
+                stats["invalidations"] += 1
+    return path
+
+
+def lookup(key):
+    """Path of the cached archive for key, or None. Hits count as a use."""
+    path = os.path.join(generation_dir(), key + ".zip")
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        stats["misses"] += 1
+        return None
+    stats["hits"] += 1
+    return path
+
+
+def store(key, chunks):
+    """
+    Pass chunks through while writing them to the cache. The entry is only
+    published once the archive is complete, so an aborted download leaves
+    nothing behind.
+    """
+    folder = generation_dir()
+    f = tempfile.NamedTemporaryFile(dir=folder, delete=False, suffix=".part")
+    try:
+        with f:
+            for chunk in chunks:
+                f.write(chunk)
+                yield chunk
+        os.replace(f.name, os.path.join(folder, key + ".zip"))
+        stats["stores"] += 1
+    finally:
+        if os.path.exists(f.name):
+            os.remove(f.name)
+    evict()
+
+
+def cache_size():
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, files in os.walk(cache_dir())
+        for name in files
+        if name.endswith(".zip")
+    )
+
+
+def evict(budget=None):
+    """Remove the least recently used archives until under budget bytes."""
+    budget = settings.DOWNLOAD_CACHE_BYTES if budget is None else budget
+    entries = []
+    for root, _, files in os.walk(cache_dir()):
+        for name in files:
+            if name.endswith(".zip"):
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= budget:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        stats["evictions"] += 1
@@ -0,0 +1,954 @@
+"""
+Building download archives: turning a download request into per-file
+exports, running them through COPY and writing the ZIP as a stream. Used by
+download_data and by the download job worker.
+
+The ingest commands also write every cruise/level of every download table as
+a gzipped CSV fragment, next to a copy of its TableHeader. Requests without
+date or bbox filters are answered by concatenating those.
+
+Files are written as CSV, or re-encoded to Parquet or Arrow IPC with a
+schema typed from the model fields.
+"""
+
+import gzip
+import io
+import json
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from functools import partial
+from itertools import chain
+
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+from django.conf import settings
+from django.contrib.gis.geos import Polygon
+from django.core.exceptions import EmptyResultSet
+from django.db import connection
+from django.db.models import Q
+
+from .cache import bump_ingest_generation, ingest_generation
+from .ingest import POLICY_FILES
+from .models import (
+    DownloadAODAP,
+    DownloadAODDaily,
+    DownloadAODSeries,
+    DownloadSDAAP,
+    DownloadSDADaily,
+    DownloadSDASeries,
+    TableHeader,
+)
+
+# How much compressed output is buffered before it is handed to the client.
+FLUSH_BYTES = 1 << 20
+# Exports run concurrently when a request asks for several files; each one is
+# spooled in memory up to SPOOL_BYTES and on disk past that.
+EXPORT_WORKERS = 4
+SPOOL_BYTES = 8 << 20
+
+# Where the data usage policy files are extracted to by import_dd.
+POLICY_DIR = r"./src"
+
+# Written to DOWNLOAD_FRAGMENTS_DIR, holding the ingest generation the
+# fragments were built for.
+FRAGMENTS_READY = "READY"
+
+# File extension of each download format.
+EXPORT_FORMATS = {"csv": ".csv", "parquet": ".parquet", "arrow": ".arrow"}
+
+# Column types in the Parquet and Arrow exports, by Django field type. Other
+# fields are written as strings.
+ARROW_TYPES = {
+    "DateField": pa.date32(),
+    "TimeField": pa.time32("s"),
+    "FloatField": pa.float64(),
+    "IntegerField": pa.int32(),
+}
+# The MAN files mark missing values with -999; the typed formats use nulls.
+MISSING_VALUES = ["", "-999", "-999.0"]
+
+# Filled by table_headers().
+header_cache = {}
+
+# Kept in every export, whatever columns the request asks for.
+REQUIRED_COLUMNS = (
+    "date_DD_MM_YYYY",
+    "time_HH_MM_SS",
+    "coordinates_wkt",
+    "cruise",
+    "level",
+)
+
+DOWNLOAD_FILES = {
+    ("SDA", "Point"): (DownloadSDAAP, "MAN_DATASET_SDA_POINT"),
+    ("SDA", "Series"): (DownloadSDASeries, "MAN_DATASET_SDA_SERIES"),
+    ("SDA", "Daily"): (DownloadSDADaily, "MAN_DATASET_SDA_DAILY"),
+    ("AOD", "Daily"): (DownloadAODDaily, "MAN_DATASET_AOD_DAILY"),
+    ("AOD", "Series"): (DownloadAODSeries, "MAN_DATASET_AOD_SERIES"),
+    ("AOD", "Point"): (DownloadAODAP, "MAN_DATASET_AOD_POINT"),
+}
+
+quality_map = {"Level 1.0": 10, "Level 1.5": 15, "Level 2.0": 20}
+
+# Model field -> column name in the original MAN files.
+aod_dict = {
+    "date_DD_MM_YYYY": "Date(dd:mm:yyyy)",
+    "time_HH_MM_SS": "Time(hh:mm:ss)",
+    "air_mass": "Air Mass",
+    "aod_340nm": "AOD_340nm",
+    "aod_380nm": "AOD_380nm",
+    "aod_440nm": "AOD_440nm",
+    "aod_500nm": "AOD_500nm",
+    "aod_675nm": "AOD_675nm",
+    "aod_870nm": "AOD_870nm",
+    "aod_1020nm": "AOD_1020nm",
+    "aod_1640nm": "AOD_1640nm",
+    "water_vapor_CM": "Water Vapor(cm)",
+    "angstrom_exponent_440_870": "440-870nm_Angstrom_Exponent",
+    "std_340nm": "STD_340nm",
+    "std_380nm": "STD_380nm",
+    "std_440nm": "STD_440nm",
+    "std_500nm": "STD_500nm",
+    "std_675nm": "STD_675nm",
+    "std_870nm": "STD_870nm",
+    "std_1020nm": "STD_1020nm",
+    "std_1640nm": "STD_1640nm",
+    "std_water_vapor_CM": "STD_Water_Vapor(cm)",
+    "std_angstrom_exponent_440_870": "STD_440-870nm_Angstrom_Exponent",
+    "number_of_observations": "Number_of_Observations",
+    "last_processing_date_DD_MM_YYYY": "Last_Processing_Date(dd:mm:yyyy)",
+    "aeronet_number": "AERONET_Number",
+    "microtops_number": "Microtops_Number",
+}
+
+sda_dict = {
+    "date_DD_MM_YYYY": "Date(dd:mm:yyyy)",
+    "time_HH_MM_SS": "Time(hh:mm:ss)",
+    "julian_day": "Julian_Day",
+    "air_mass": "Air_Mass",
+    "total_aod_500nm": "Total_AOD_500nm(tau_a)",
+    "fine_mode_aod_500nm": "Fine_Mode_AOD_500nm(tau_f)",
+    "coarse_mode_aod_500nm": "Coarse_Mode_AOD_500nm(tau_c)",
+    "fine_mode_fraction_500nm": "FineModeFraction_500nm(eta)",
+    "coarse_mode_fraction_500nm": "CoarseModeFraction_500nm(1_eta)",
+    "regression_dtau_a": "2nd_Order_Reg_Fit_Error_Total_AOD_500nm(regression_dtau_a)",
+    "rmse_fine_mode_aod_500nm": "RMSE_Fine_Mode_AOD_500nm(Dtau_f)",
+    "rmse_coarse_mode_aod_500nm": "RMSE_Coarse_Mode_AOD_500nm(Dtau_c)",
+    "rmse_fmf_and_cmf_fractions_500nm": "RMSE_FMF_and_CMF_Fractions_500nm(Deta)",
+    "angstrom_exponent_total_500nm": "Angstrom_Exponent(AE)_Total_500nm(alpha)",
+    "dae_dln_wavelength_total_500nm": "dAE/dln(wavelength)_Total_500nm(alphap)",
+    "ae_fine_mode_500nm": "AE_Fine_Mode_500nm(alpha_f)",
+    "dae_dln_wavelength_fine_mode_500nm": "dAE/dln(wavelength)_Fine_Mode_500nm(alphap_f)",
+    "aod_870nm": "870nm_Input_AOD",
+    "aod_675nm": "675nm_Input_AOD",
+    "aod_500nm": "500nm_Input_AOD",
+    "aod_440nm": "440nm_Input_AOD",
+    "aod_380nm": "380nm_Input_AOD",
+    "stdev_total_aod_500nm": "STDEV-Total_AOD_500nm(tau_a)",
+    "stdev_fine_mode_aod_500nm": "STDEV-Fine_Mode_AOD_500nm(tau_f)",
+    "stdev_coarse_mode_aod_500nm": "STDEV-Coarse_Mode_AOD_500nm(tau_c)",
+    "stdev_fine_mode_fraction_500nm": "STDEV-FineModeFraction_500nm(eta)",
+    "stdev_coarse_mode_fraction_500nm": "STDEV-CoarseModeFraction_500nm(1_eta)",
+    "stdev_regression_dtau_a": "STDEV-2nd_Order_Reg_Fit_Error_Total_AOD_500nm(regression_dtau_a)",
+    "stdev_rmse_fine_mode_aod_500nm": "STDEV-RMSE_Fine_Mode_AOD_500nm(Dtau_f)",
+    "stdev_rmse_coarse_mode_aod_500nm": "STDEV-RMSE_Coarse_Mode_AOD_500nm(Dtau_c)",
+    "stdev_rmse_fmf_and_cmf_fractions_500nm": "STDEV-RMSE_FMF_and_CMF_Fractions_500nm(Deta)",
+    "stdev_angstrom_exponent_total_500nm": "STDEV-Angstrom_Exponent(AE)_Total_500nm(alpha)",
+    "stdev_dae_dln_wavelength_total_500nm": "STDEV-dAE/dln(wavelength)_Total_500nm(alphap)",
+    "stdev_ae_fine_mode_500nm": "STDEV-AE_Fine_Mode_500nm(alpha_f)",
+    "stdev_dae_dln_wavelength_fine_mode_500nm": "STDEV-dAE/dln(wavelength)_Fine_Mode_500nm(alphap_f)",
+    "stdev_aod_870nm": "STDEV-870nm_Input_AOD",
+    "stdev_aod_675nm": "STDEV-675nm_Input_AOD",
+    "stdev_aod_500nm": "STDEV-500nm_Input_AOD",
+    "solar_zenith_angle": "Solar_Zenith_Angle",
+    "stdev_aod_440nm": "STDEV-440nm_Input_AOD",
+    "stdev_aod_380nm": "STDEV-380nm_Input_AOD",
+    "number_of_observations": "Number_of_Observations",
+    "last_processing_date_DD_MM_YYYY": "Last_Processing_Date(dd:mm:yyyy)",
+    "aeronet_number": "AERONET_Number",
+    "microtops_number": "Microtops_Number",
+}
+
+
+class ZipSink:
+    """
+    Write-only, non-seekable file object for zipfile. zipfile falls back to
+    data descriptors when it cannot seek, so entries can be written in one
+    pass and the bytes drained as they are produced.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        self.size = 0
+        return data
+
+
+class ColumnarSink(ZipSink):
+    # pyarrow's writers want a position and an open/closed state.
+    closed = False
+
+    def __init__(self):
+        super().__init__()
+        self.position = 0
+
+    def write(self, data):
+        self.position += len(data)
+        return super().write(data)
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        self.closed = True
+
+
+class ChunkReader(io.RawIOBase):
+    """Readable file object over an iterable of bytes."""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.rest = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.rest:
+            self.rest = next(self.chunks, None)
+            if self.rest is None:
+                self.rest = b""
+                return 0
+        n = min(len(buffer), len(self.rest))
+        buffer[:n] = self.rest[:n]
+        self.rest = self.rest[n:]
+        return n
+
+
+def zip_entry(arcname):
+    info = zipfile.ZipInfo(arcname, date_time=time.localtime()[:6])
+    info.compress_type = zipfile.ZIP_DEFLATED
+    info.external_attr = 0o644 << 16
+    return info
+
+
+def stream_zip(entries):
+    """
+    Yield a ZIP archive chunk by chunk. entries is an iterable of
+    (arcname, iterable of bytes); each entry is consumed lazily, so only
+    about FLUSH_BYTES of output is held in memory at a time.
+    """
+    sink = ZipSink()
+    with zipfile.ZipFile(sink, mode="w") as archive:
+        for arcname, chunks in entries:
+            with archive.open(zip_entry(arcname), mode="w", force_zip64=True) as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    if sink.size >= FLUSH_BYTES:
+                        yield sink.drain()
+            yield sink.drain()
+    yield sink.drain()
+
+
+def file_chunks(path, chunk_size=FLUSH_BYTES):
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            yield chunk
+
+
+def policy_entries(folder, src_dir, policy_files):
+    for policy_file in policy_files:
+        path = os.path.join(src_dir, policy_file)
+        if os.path.isfile(path):
+            yield os.path.join(folder, policy_file), file_chunks(path)
+        else:
+            print(f"Source policy file {path} does not exist")
+
+
+class CopyPipe:
+    """
+    File object handed to copy_expert in a worker thread. Iterating it in the
+    request thread yields what COPY wrote, about chunk_bytes at a time; the
+    bounded queue keeps the database from running ahead of the client.
+    """
+
+    done = object()
+
+    def __init__(self, chunk_bytes=FLUSH_BYTES, depth=4):
+        self.chunk_bytes = chunk_bytes
+        self.rows = 0
+        self.buffer = bytearray()
+        self.queue = queue.Queue(depth)
+        self.cancelled = threading.Event()
+
+    def put(self, item):
+        while not self.cancelled.is_set():
+            try:
+                self.queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+        raise OSError("export cancelled")
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= self.chunk_bytes:
+            self.put(bytes(self.buffer))
+            self.buffer.clear()
+        return len(data)
+
+    def finish(self, error=None):
+        if error is None and self.buffer:
+            self.put(bytes(self.buffer))
+        self.put(self.done if error is None else error)
+
+    def __iter__(self):
+        while (item := self.queue.get()) is not self.done:
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+
+
+def copy_statement(cursor, query, columns):
+    """
+    COPY statement exporting query, or None when Django can tell it matches
+    nothing (cruise__in=[] and the like) and builds no SQL.
+    """
+    try:
+        sql, params = query.values_list(*columns).query.sql_with_params()
+    except EmptyResultSet:
+        return None
+    return "COPY ({}) TO STDOUT WITH CSV".format(
+        cursor.mogrify(sql, params).decode("utf-8")
+    )
+
+
+def run_copy(statement, pipe):
+    # Runs in its own thread, so it gets (and must close) its own connection.
+    try:
+        with connection.cursor() as cursor:
+            cursor.cursor.copy_expert(statement, pipe)
+            pipe.rows = cursor.cursor.rowcount
+        pipe.finish()
+    except Exception as e:
+        if not pipe.cancelled.is_set():
+            pipe.finish(e)
+    finally:
+        connection.close()
+
+
+def copy_csv(query, columns, done=None):
+    """
+    Yield the rows of query, restricted to columns, as CSV bytes produced by
+    COPY (SELECT ...) TO STDOUT. Rows never become Python objects. done, if
+    given, is called with the row count once everything has been yielded.
+    """
+    with connection.cursor() as cursor:
+        statement = copy_statement(cursor.cursor, query, columns)
+    if statement is None:
+        if done is not None:
+            done(0)
+        return
+    pipe = CopyPipe()
+    threading.Thread(target=run_copy, args=(statement, pipe), daemon=True).start()
+    try:
+        yield from pipe
+    finally:
+        pipe.cancelled.set()
+    if done is not None:
+        done(pipe.rows)
+
+
+def spool_copy(statement):
+    # Same as run_copy, but into a spool so several exports can run at once.
+    spool = tempfile.SpooledTemporaryFile(SPOOL_BYTES)
+    try:
+        with connection.cursor() as cursor:
+            cursor.cursor.copy_expert(statement, spool)
+            rows = cursor.cursor.rowcount
+    except Exception:
+        spool.close()
+        raise
+    finally:
+        connection.close()
+    spool.seek(0)
+    return spool, rows
+
+
+def spool_chunks(spool):
+    with spool:
+        while chunk := spool.read(FLUSH_BYTES):
+            yield chunk
+
+
+class DownloadProfile:
+    """
+    Query count and per-stage timings of one download request, printed once
+    the archive has been sent. Install it with connection.execute_wrapper;
+    COPY exports run on their own connections and are counted separately.
+    """
+
+    def __init__(self, label):
+        self.label = label
+        self.queries = 0
+        self.exports = 0
+        self.stages = []
+        self.last = time.perf_counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        self.queries += 1
+        return execute(sql, params, many, context)
+
+    def stage(self, name):
+        now = time.perf_counter()
+        self.stages.append((name, now - self.last))
+        self.last = now
+
+    def report(self):
+        timings = ", ".join(
+            f"{name} {seconds * 1000:.1f}ms" for name, seconds in self.stages
+        )
+        print(
+            f"{self.label}: {self.queries} queries, {self.exports} exports, "
+            f"{timings}"
+        )
+
+
+def profiled(chunks, profile):
+    # Keeps counting queries while the response streams, then reports.
+    with connection.execute_wrapper(profile):
+        yield from chunks
+    profile.stage("stream")
+    profile.report()
+
+
+def ignore_progress(arcname, rows):
+    pass
+
+
+def export_entries(exports, workers=EXPORT_WORKERS, progress=ignore_progress):
+    """
+    Turn (arcname, encode, query, columns) exports into zip entries,
+    skipping exports without rows. A single export is streamed straight from
+    COPY, and its entry only starts once the first rows arrive; several run on
+    a pool of workers, each with its own connection, and are yielded in the
+    order they finish. progress is called with (arcname, rows) as each export
+    completes.
+    """
+    if len(exports) == 1:
+        arcname, encode, query, columns = exports[0]
+        chunks = copy_csv(query, columns, partial(progress, arcname))
+        first = next(chunks, None)
+        if first is not None:
+            yield arcname, encode(chain([first], chunks))
+        return
+
+    with connection.cursor() as cursor:
+        statements = [
+            copy_statement(cursor.cursor, query, columns)
+            for _, _, query, columns in exports
+        ]
+    for statement, (arcname, *_) in zip(statements, exports):
+        if statement is None:
+            progress(arcname, 0)
+    pool = ThreadPoolExecutor(max_workers=workers)
+    pending = ()
+    try:
+        futures = {
+            pool.submit(spool_copy, statement): export
+            for statement, export in zip(statements, exports)
+            if statement is not None
+        }
+        pending = set(futures)
+        for future in as_completed(futures):
+            pending.discard(future)
+            arcname, encode, *_ = futures[future]
+            spool, rows = future.result()
+            progress(arcname, rows)
+            if rows == 0:
+                spool.close()
+                continue
+            yield arcname, encode(spool_chunks(spool))
+    finally:
+        # The client may have gone away: drop queued exports and the spools
+        # of those that will never be sent.
+        pool.shutdown(wait=False, cancel_futures=True)
+        for future in pending:
+            future.add_done_callback(discard_spool)
+
+
+def discard_spool(future):
+    if not future.cancelled() and future.exception() is None:
+        future.result()[0].close()
+
+
+def export_columns(model, wanted=None):
+    """
+    Fields written for model, in model order. wanted restricts them to those
+    fields plus REQUIRED_COLUMNS; None keeps everything.
+    """
+    # The Point column is left out; coordinates_wkt is written under the
+    # "coordinates" header instead.
+    return [
+        field.name
+        for field in model._meta.fields[1:]
+        if field.name != "coordinates"
+        and (wanted is None or field.name in wanted or field.name in REQUIRED_COLUMNS)
+    ]
+
+
+def column_field(name):
+    """The model field a requested column refers to, by field or MAN name."""
+    if name == "coordinates":
+        return "coordinates_wkt"
+    fields = {
+        column
+        for model, _ in DOWNLOAD_FILES.values()
+        for column in export_columns(model)
+    }
+    if name in fields:
+        return name
+    for translate in (aod_dict, sda_dict):
+        for field, header in translate.items():
+            if header == name:
+                return field
+    raise ValueError(f"Unknown column {name!r}")
+
+
+def export_header(datatype, columns):
+    """Column names of an export, as in the original MAN files."""
+    translate = sda_dict if datatype == "SDA" else aod_dict
+    return [
+        "coordinates" if name == "coordinates_wkt" else translate.get(name, name)
+        for name in columns
+    ]
+
+
+def export_preamble(header, columns):
+    """The lines written above the rows of a CSV export, from its TableHeader."""
+    columns = export_header(header.datatype, columns)
+    return (
+        f"{header.base_header_l1}"
+        f"{header.freq},** interpolated 500nm channel **\n"
+        f"{header.base_header_l2}"
+        f"{','.join(columns)}\n"
+    ).encode("utf-8")
+
+
+def export_schema(header, columns):
+    """
+    Arrow schema of a Parquet or Arrow export, typed from the model fields,
+    with the TableHeader text kept as metadata.
+    """
+    model, _ = DOWNLOAD_FILES[(header.datatype, header.freq)]
+    return pa.schema(
+        [
+            pa.field(
+                name,
+                ARROW_TYPES.get(
+                    model._meta.get_field(column).get_internal_type(), pa.string()
+                ),
+            )
+            for name, column in zip(export_header(header.datatype, columns), columns)
+        ],
+        metadata={
+            "man_header_l1": header.base_header_l1.rstrip("\n"),
+            "man_header_l2": header.base_header_l2.rstrip("\n"),
+            "datatype": header.datatype,
+            "freq": header.freq,
+            "level": str(header.level),
+        },
+    )
+
+
+def columnar_chunks(chunks, schema, file_format):
+    """Re-encode CSV rows (no header line) as a Parquet or Arrow IPC file."""
+    reader = pacsv.open_csv(
+        io.BufferedReader(ChunkReader(chunks), FLUSH_BYTES),
+        read_options=pacsv.ReadOptions(
+            column_names=schema.names, block_size=FLUSH_BYTES
+        ),
+        convert_options=pacsv.ConvertOptions(
+            column_types=schema, null_values=MISSING_VALUES, strings_can_be_null=True
+        ),
+    )
+    sink = ColumnarSink()
+    if file_format == "parquet":
+        writer = pq.ParquetWriter(sink, schema, compression="zstd")
+    else:
+        writer = pa.ipc.new_file(sink, schema)
+    with writer:
+        for batch in reader:
+            writer.write_batch(batch)
+            if sink.size >= FLUSH_BYTES:
+                yield sink.drain()
+    yield sink.drain()
+
+
+def export_encoder(header, file_format, columns):
+    """Turns the CSV rows of an export into the bytes of its file."""
+    if file_format == "csv":
+        preamble = export_preamble(header, columns)
+        return lambda chunks: chain([preamble], chunks)
+    return partial(
+        columnar_chunks, schema=export_schema(header, columns), file_format=file_format
+    )
+
+
+def table_headers():
+    """
+    Every TableHeader by (datatype, freq, level). Loaded once per process and
+    again whenever an ingest bumps the generation.
+    """
+    generation = ingest_generation()
+    if header_cache.get("generation") != generation:
+        header_cache["headers"] = {
+            (header.datatype, header.freq, header.level): header
+            for header in TableHeader.objects.all()
+        }
+        header_cache["generation"] = generation
+    return header_cache["headers"]
+
+
+def download_params(data):
+    """
+    Normalize a download_data request body. The result is canonical (sorted,
+    defaults folded to None), so it can be hashed or stored as is.
+    """
+    file_format = str(data.get("format") or "csv").lower()
+    if file_format not in EXPORT_FORMATS:
+        raise ValueError(
+            f"Unknown format {file_format!r}; expected one of "
+            f"{', '.join(EXPORT_FORMATS)}"
+        )
+    columns = data.get("columns") or None
+    if columns is not None:
+        columns = sorted({column_field(name) for name in columns})
+    start_date = data.get("start_date", "")
+    end_date = data.get("end_date", "")
+    bounds = [data.get(key) for key in ("min_lng", "min_lat", "max_lng", "max_lat")]
+
+    # The full range the frontend sends by default means "no date filter".
+    if start_date == datetime(2004, 10, 16).strftime("%Y-%m-%d"):
+        start_date = None
+    if end_date == datetime.now().date().strftime("%Y-%m-%d"):
+        end_date = None
+
+    return {
+        "sites": sorted(set(data.get("sites", []))),
+        "retrievals": sorted(set(data.get("retrievals", []))),
+        "frequency": sorted(set(data.get("frequency", []))),
+        "quality": sorted(set(data.get("quality", []))),
+        "format": file_format,
+        "columns": columns,
+        "start_date": start_date or None,
+        "end_date": end_date or None,
+        "bbox": (
+            [float(value) for value in bounds]
+            if all(value is not None for value in bounds)
+            else None
+        ),
+    }
+
+
+def download_exports(params, folder):
+    """
+    One (arcname, encode, query, columns) export per requested retrieval,
+    frequency and level that has a TableHeader.
+    """
+    date_filter = Q()
+    if params["start_date"]:
+        date_filter &= Q(date_DD_MM_YYYY__gte=params["start_date"])
+    if params["end_date"]:
+        date_filter &= Q(date_DD_MM_YYYY__lte=params["end_date"])
+
+    extension = EXPORT_FORMATS[params["format"]]
+    headers = table_headers()
+    exports = []
+    for retrieval in params["retrievals"]:
+        for freq in params["frequency"]:
+            if (retrieval, freq) not in DOWNLOAD_FILES:
+                continue
+            model, filename = DOWNLOAD_FILES[(retrieval, freq)]
+            columns = export_columns(model, params["columns"])
+
+            for level in params["quality"]:
+                level_value = quality_map.get(level)
+                cur_header = headers.get((retrieval, freq, level_value))
+                if cur_header is None:
+                    continue
+
+                query = model.objects.filter(
+                    cruise__in=params["sites"], level=level_value
+                )
+                if date_filter:
+                    query = query.filter(date_filter)
+                if params["bbox"] is not None:
+                    query = query.filter(
+                        coordinates__within=Polygon.from_bbox(params["bbox"])
+                    )
+
+                exports.append(
+                    (
+                        os.path.join(folder, f"{filename}{level_value}{extension}"),
+                        export_encoder(cur_header, params["format"], columns),
+                        query,
+                        columns,
+                    )
+                )
+    return exports
+
+
+def explain_rows(cursor, query, columns):
+    # The planner's row count and average row width (bytes) for query.
+    try:
+        sql, params = query.values_list(*columns).query.sql_with_params()
+    except EmptyResultSet:
+        # The filter matches nothing (e.g. no sites selected).
+        return 0, 0
+    cursor.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+    plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]["Plan"]["Plan Rows"], plan[0]["Plan"]["Plan Width"]
+
+
+def estimate_exports(exports):
+    """
+    (arcname, rows, bytes) for each export, from the planner's statistics.
+    No rows are read, so the figures are only as good as the last ANALYZE.
+    """
+    estimates = []
+    with connection.cursor() as cursor:
+        for arcname, _, query, columns in exports:
+            rows, width = explain_rows(cursor, query, columns)
+            estimates.append((arcname, rows, rows * width))
+    return estimates
+
+
+def download_action(rows):
+    """What download_data does with a request of about rows rows."""
+    if settings.DOWNLOAD_MAX_ROWS and rows > settings.DOWNLOAD_MAX_ROWS:
+        return "refuse"
+    if settings.DOWNLOAD_DEFER_ROWS and rows > settings.DOWNLOAD_DEFER_ROWS:
+        return "defer"
+    return "stream"
+
+
+def fragment_dir(retrieval, freq, level):
+    return os.path.join(settings.DOWNLOAD_FRAGMENTS_DIR, f"{retrieval}_{freq}_{level}")
+
+
+def fragment_path(retrieval, freq, level, cruise):
+    return os.path.join(fragment_dir(retrieval, freq, level), f"{cruise}.csv.gz")
+
+
+def rows_path(fragment):
+    return fragment[: -len(".csv.gz")] + ".rows"
+
+
+def write_fragment(cursor, retrieval, freq, level, cruise):
+    """
+    COPY the rows of one cruise/level into its gzipped fragment, in the same
+    form download_exports would produce. A fragment without rows is removed.
+    Returns the row count.
+    """
+    model, _ = DOWNLOAD_FILES[(retrieval, freq)]
+    path = fragment_path(retrieval, freq, level, cruise)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    statement = copy_statement(
+        cursor.cursor,
+        model.objects.filter(cruise=cruise, level=level),
+        export_columns(model),
+    )
+    with gzip.open(path + ".part", "wb", compresslevel=6) as f:
+        cursor.cursor.copy_expert(statement, f)
+        rows = cursor.cursor.rowcount
+    if rows > 0:
+        with open(rows_path(path), "w") as f:
+            f.write(str(rows))
+        os.replace(path + ".part", path)
+    else:
+        os.remove(path + ".part")
+        for stale in (path, rows_path(path)):
+            if os.path.exists(stale):
+                os.remove(stale)
+    return rows
+
+
+def write_headers():
+    # The TableHeader of every fragment folder, so serving them needs no query.
+    for header in TableHeader.objects.all():
+        if (header.datatype, header.freq) not in DOWNLOAD_FILES:
+            continue
+        folder = fragment_dir(header.datatype, header.freq, header.level)
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, "header.part"), "w") as f:
+            json.dump(
+                {
+                    "datatype": header.datatype,
+                    "freq": header.freq,
+                    "level": header.level,
+                    "base_header_l1": header.base_header_l1,
+                    "base_header_l2": header.base_header_l2,
+                },
+                f,
+            )
+        os.replace(
+            os.path.join(folder, "header.part"), os.path.join(folder, "header.json")
+        )
+
+
+def invalidate_fragments():
+    """Stop serving fragments; called before an ingest touches the tables."""
+    try:
+        os.remove(os.path.join(settings.DOWNLOAD_FRAGMENTS_DIR, FRAGMENTS_READY))
+    except FileNotFoundError:
+        pass
+
+
+def build_fragments(keys=None):
+    """
+    Write the per-cruise export fragments and their headers. keys is an
+    iterable of (retrieval, freq, level, cruise) to rewrite; None rebuilds
+    everything. Returns the number of fragments written.
+    """
+    with connection.cursor() as cursor:
+        if keys is None:
+            shutil.rmtree(settings.DOWNLOAD_FRAGMENTS_DIR, ignore_errors=True)
+            keys = [
+                (retrieval, freq, level, cruise)
+                for (retrieval, freq), (model, _) in DOWNLOAD_FILES.items()
+                for cruise, level in model.objects.order_by()
+                .values_list("cruise", "level")
+                .distinct()
+            ]
+        written = sum(
+            write_fragment(cursor, retrieval, freq, int(level), cruise) > 0
+            for retrieval, freq, level, cruise in keys
+        )
+    write_headers()
+    return written
+
+
+def mark_fragments_ready(generation):
+    """Serve fragments for as long as generation is the ingest generation."""
+    os.makedirs(settings.DOWNLOAD_FRAGMENTS_DIR, exist_ok=True)
+    with open(os.path.join(settings.DOWNLOAD_FRAGMENTS_DIR, FRAGMENTS_READY), "w") as f:
+        f.write(generation)
+
+
+def bump_generation_keeping_fragments():
+    """
+    Bump the ingest generation for a change the fragments do not depend on
+    (site span dates), so cached results go but the fragments stay in use.
+    """
+    ready = fragments_ready()
+    generation = bump_ingest_generation()
+    if ready:
+        mark_fragments_ready(generation)
+    return generation
+
+
+def fragments_ready():
+    try:
+        with open(os.path.join(settings.DOWNLOAD_FRAGMENTS_DIR, FRAGMENTS_READY)) as f:
+            return f.read().strip() == ingest_generation()
+    except FileNotFoundError:
+        return False
+
+
+def fragment_chunks(paths, done):
+    rows = 0
+    for path in paths:
+        with gzip.open(path, "rb") as f:
+            while chunk := f.read(FLUSH_BYTES):
+                yield chunk
+        with open(rows_path(path)) as f:
+            rows += int(f.read())
+    done(rows)
+
+
+def fragment_entries(params, folder, progress=ignore_progress):
+    """
+    Zip entries for an unfiltered request, concatenated from the fragments of
+    the requested cruises without touching the database.
+    """
+    extension = EXPORT_FORMATS[params["format"]]
+    entries = []
+    for retrieval in params["retrievals"]:
+        for freq in params["frequency"]:
+            if (retrieval, freq) not in DOWNLOAD_FILES:
+                continue
+            model, filename = DOWNLOAD_FILES[(retrieval, freq)]
+            for level in params["quality"]:
+                level_value = quality_map.get(level)
+                header = os.path.join(
+                    fragment_dir(retrieval, freq, level_value), "header.json"
+                )
+                if not os.path.exists(header):
+                    continue
+                with open(header) as f:
+                    encode = export_encoder(
+                        TableHeader(**json.load(f)),
+                        params["format"],
+                        export_columns(model),
+                    )
+                arcname = os.path.join(folder, f"{filename}{level_value}{extension}")
+                # Site names come from the request: only names matching a
+                # fragment on disk are turned into paths.
+                available = set(os.listdir(fragment_dir(retrieval, freq, level_value)))
+                paths = [
+                    fragment_path(retrieval, freq, level_value, cruise)
+                    for cruise in params["sites"]
+                    if f"{cruise}.csv.gz" in available
+                ]
+                if not paths:
+                    progress(arcname, 0)
+                    continue
+                done = partial(progress, arcname)
+                entries.append((arcname, encode(fragment_chunks(paths, done))))
+    return entries
+
+
+def archive_entries(params, folder, progress=ignore_progress, workers=EXPORT_WORKERS):
+    """
+    Everything that goes into a download archive, policy files last, and the
+    number of data files it was built from. Requests for every column
+    without a date or bbox filter are served from the fragments when they
+    are current.
+    """
+    unfiltered = (
+        params["start_date"] is None
+        and params["end_date"] is None
+        and params["bbox"] is None
+        and params["columns"] is None
+    )
+    if unfiltered and fragments_ready():
+        entries = fragment_entries(params, folder, progress)
+        files = len(entries)
+    else:
+        exports = download_exports(params, folder)
+        entries = export_entries(exports, workers, progress)
+        files = len(exports)
+    return files, chain(entries, policy_entries(folder, POLICY_DIR, POLICY_FILES))
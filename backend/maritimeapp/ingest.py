@@ -0,0 +1,674 @@
+"""
+Helpers shared by the MAN ingest commands (import_dd, psql_add, direct_ingest).
+"""
+
+import hashlib
+import os
+import re
+import shutil
+import struct
+import tarfile
+from itertools import chain, repeat
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import requests
+from django.contrib.gis.db import models as gis_models
+from django.contrib.gis.geos import Point
+from django.db import models
+
+SRID = 4326
+
+# Lines 0-4 of every MAN file: l1 header, cruise, l2 header, PI, column names.
+HEADER_LINES = 5
+BLOCK_SIZE = 8 << 20
+SOURCE_DATE_FORMAT = "%d:%m:%Y"
+
+MAN_ARCHIVE_URL = "https://aeronet.gsfc.nasa.gov/new_web/All_MAN_Data_V3.tar.gz"
+# Shipped in the archive and added to every download_data zip.
+POLICY_FILES = ["data_usage_policy.pdf", "data_usage_policy.txt"]
+
+aod_dict = {
+    "Date(dd:mm:yyyy)": "date_DD_MM_YYYY",
+    "Time(hh:mm:ss)": "time_HH_MM_SS",
+    "Air Mass": "air_mass",
+    "AOD_340nm": "aod_340nm",
+    "AOD_380nm": "aod_380nm",
+    "AOD_440nm": "aod_440nm",
+    "AOD_500nm": "aod_500nm",
+    "AOD_675nm": "aod_675nm",
+    "AOD_870nm": "aod_870nm",
+    "AOD_1020nm": "aod_1020nm",
+    "AOD_1640nm": "aod_1640nm",
+    "Water Vapor(cm)": "water_vapor_CM",
+    "440-870nm_Angstrom_Exponent": "angstrom_exponent_440_870",
+    "STD_340nm": "std_340nm",
+    "STD_380nm": "std_380nm",
+    "STD_440nm": "std_440nm",
+    "STD_500nm": "std_500nm",
+    "STD_675nm": "std_675nm",
+    "STD_870nm": "std_870nm",
+    "STD_1020nm": "std_1020nm",
+    "STD_1640nm": "std_1640nm",
+    "STD_Water_Vapor(cm)": "std_water_vapor_CM",
+    "STD_440-870nm_Angstrom_Exponent": "std_angstrom_exponent_440_870",
+    "Number_of_Observations": "number_of_observations",
+    "Last_Processing_Date(dd:mm:yyyy)": "last_processing_date_DD_MM_YYYY",
+    "AERONET_Number": "aeronet_number",
+    "Microtops_Number": "microtops_number",
+}
+
+sda_dict = {
+    "Date(dd:mm:yyyy)": "date_DD_MM_YYYY",
+    "Time(hh:mm:ss)": "time_HH_MM_SS",
+    "Julian_Day": "julian_day",
+    "Air_Mass": "air_mass",
+    "Total_AOD_500nm(tau_a)": "total_aod_500nm",
+    "Fine_Mode_AOD_500nm(tau_f)": "fine_mode_aod_500nm",
+    "Coarse_Mode_AOD_500nm(tau_c)": "coarse_mode_aod_500nm",
+    "FineModeFraction_500nm(eta)": "fine_mode_fraction_500nm",
+    "CoarseModeFraction_500nm(1_eta)": "coarse_mode_fraction_500nm",
+    "2nd_Order_Reg_Fit_Error_Total_AOD_500nm(regression_dtau_a)": "regression_dtau_a",
+    "RMSE_Fine_Mode_AOD_500nm(Dtau_f)": "rmse_fine_mode_aod_500nm",
+    "RMSE_Coarse_Mode_AOD_500nm(Dtau_c)": "rmse_coarse_mode_aod_500nm",
+    "RMSE_FMF_and_CMF_Fractions_500nm(Deta)": "rmse_fmf_and_cmf_fractions_500nm",
+    "Angstrom_Exponent(AE)_Total_500nm(alpha)": "angstrom_exponent_total_500nm",
+    "dAE/dln(wavelength)_Total_500nm(alphap)": "dae_dln_wavelength_total_500nm",
+    "AE_Fine_Mode_500nm(alpha_f)": "ae_fine_mode_500nm",
+    "dAE/dln(wavelength)_Fine_Mode_500nm(alphap_f)": "dae_dln_wavelength_fine_mode_500nm",
+    "870nm_Input_AOD": "aod_870nm",
+    "675nm_Input_AOD": "aod_675nm",
+    "500nm_Input_AOD": "aod_500nm",
+    "440nm_Input_AOD": "aod_440nm",
+    "380nm_Input_AOD": "aod_380nm",
+    "STDEV-Total_AOD_500nm(tau_a)": "stdev_total_aod_500nm",
+    "STDEV-Fine_Mode_AOD_500nm(tau_f)": "stdev_fine_mode_aod_500nm",
+    "STDEV-Coarse_Mode_AOD_500nm(tau_c)": "stdev_coarse_mode_aod_500nm",
+    "STDEV-FineModeFraction_500nm(eta)": "stdev_fine_mode_fraction_500nm",
+    "STDEV-CoarseModeFraction_500nm(1_eta)": "stdev_coarse_mode_fraction_500nm",
+    "STDEV-2nd_Order_Reg_Fit_Error_Total_AOD_500nm(regression_dtau_a)": "stdev_regression_dtau_a",
+    "STDEV-RMSE_Fine_Mode_AOD_500nm(Dtau_f)": "stdev_rmse_fine_mode_aod_500nm",
+    "STDEV-RMSE_Coarse_Mode_AOD_500nm(Dtau_c)": "stdev_rmse_coarse_mode_aod_500nm",
+    "STDEV-RMSE_FMF_and_CMF_Fractions_500nm(Deta)": "stdev_rmse_fmf_and_cmf_fractions_500nm",
+    "STDEV-Angstrom_Exponent(AE)_Total_500nm(alpha)": "stdev_angstrom_exponent_total_500nm",
+    "STDEV-dAE/dln(wavelength)_Total_500nm(alphap)": "stdev_dae_dln_wavelength_total_500nm",
+    "STDEV-AE_Fine_Mode_500nm(alpha_f)": "stdev_ae_fine_mode_500nm",
+    "STDEV-dAE/dln(wavelength)_Fine_Mode_500nm(alphap_f)": "stdev_dae_dln_wavelength_fine_mode_500nm",
+    "STDEV-870nm_Input_AOD": "stdev_aod_870nm",
+    "STDEV-675nm_Input_AOD": "stdev_aod_675nm",
+    "STDEV-500nm_Input_AOD": "stdev_aod_500nm",
+    "Solar_Zenith_Angle": "solar_zenith_angle",
+    "STDEV-440nm_Input_AOD": "stdev_aod_440nm",
+    "STDEV-380nm_Input_AOD": "stdev_aod_380nm",
+    "Number_of_Observations": "number_of_observations",
+    "Last_Processing_Date(dd:mm:yyyy)": "last_processing_date_DD_MM_YYYY",
+    "AERONET_Number": "aeronet_number",
+    "Microtops_Number": "microtops_number",
+}
+
+DATE_COLUMNS = ["date_DD_MM_YYYY", "last_processing_date_DD_MM_YYYY"]
+INT_COLUMNS = ["number_of_observations", "aeronet_number", "microtops_number"]
+TEXT_COLUMNS = ["time_HH_MM_SS"]
+
+# EWKB point: byte order, geometry type (with the SRID flag set), SRID, x, y.
+EWKB_POINT = np.dtype(
+    [
+        ("byte_order", "u1"),
+        ("wkb_type", "<u4"),
+        ("srid", "<u4"),
+        ("x", "<f8"),
+        ("y", "<f8"),
+    ]
+)
+EWKB_SRID_FLAG = 0x20000000
+WKB_POINT = 1
+
+COORDINATE_ENCODINGS = ["geos", "ewkb", "ewkt"]
+
+
+def points_to_ewkb(lng, lat, srid=SRID):
+    packed = np.empty(len(lng), dtype=EWKB_POINT)
+    packed["byte_order"] = 1
+    packed["wkb_type"] = WKB_POINT | EWKB_SRID_FLAG
+    packed["srid"] = srid
+    packed["x"] = np.asarray(lng, dtype="f8")
+    packed["y"] = np.asarray(lat, dtype="f8")
+    return packed
+
+
+def points_to_ewkb_hex(lng, lat, srid=SRID):
+    packed = points_to_ewkb(lng, lat, srid)
+    hexed = packed.tobytes().hex().upper().encode("ascii")
+    width = 2 * EWKB_POINT.itemsize
+    return np.frombuffer(hexed, dtype=f"S{width}").astype(f"U{width}")
+
+
+def format_coordinates(values):
+    # Shortest round-trip digits in positional notation, without a trailing
+    # ".0" (1.0 -> "1", 1e-05 -> "0.00001"), as GEOS writes trimmed WKT.
+    values = np.asarray(values, dtype="f8")
+    text = pd.Series(values).astype(str).str.removesuffix(".0")
+    exponent = text.str.contains("e", regex=False).to_numpy()
+    if exponent.any():
+        text[exponent] = [
+            np.format_float_positional(value, trim="-") for value in values[exponent]
+        ]
+    return text
+
+
+def points_to_wkt(lng, lat):
+    # Same text GEOS produces for str(Point(lng, lat)).
+    return (
+        "POINT (" + format_coordinates(lng) + " " + format_coordinates(lat) + ")"
+    ).to_numpy()
+
+
+def encode_points(lng, lat, encoding):
+    if encoding == "ewkb":
+        return points_to_ewkb_hex(lng, lat)
+    if encoding == "ewkt":
+        return f"SRID={SRID};" + points_to_wkt(lng, lat).astype(object)
+    raise ValueError(f"Unknown coordinate encoding: {encoding}")
+
+
+def man_schema(columns):
+    # Dates are read as text and parsed afterwards so a malformed value
+    # becomes null instead of failing the whole block.
+    known = set(aod_dict.values()) | set(sda_dict.values())
+    schema = {}
+    for col in columns:
+        if col in DATE_COLUMNS or col in TEXT_COLUMNS:
+            schema[col] = pa.string()
+        elif col in INT_COLUMNS:
+            schema[col] = pa.int32()
+        elif col in known or col in ("Latitude", "Longitude"):
+            schema[col] = pa.float64()
+        else:
+            schema[col] = pa.string()
+    return schema
+
+
+class ManFile:
+    """
+    Streaming reader for one MAN source file.
+
+    The metadata lines are parsed up front; rows are yielded as typed pyarrow
+    record batches of roughly ``block_size`` bytes so memory stays flat no
+    matter how large the file is.
+    """
+
+    def __init__(self, file, block_size=BLOCK_SIZE):
+        self.file = file
+        self.block_size = block_size
+
+        with open(file, "r", encoding="latin-1") as f:
+            lines = [f.readline() for _ in range(HEADER_LINES)]
+
+        self.header_lines = lines
+        pi_info = lines[3]
+        self.pi = (
+            pi_info.split("=")[1].split(",")[0].replace("\n", "").replace(",", ";")
+        )
+        self.pi_email = pi_info.split(",Email=")[1].replace("\n", "").replace(",", ";")
+        self.cruise = lines[1].split(",")[0].replace("\n", "")
+
+        if ".lev" in file:
+            self.datatype = "AOD"
+            self.level = file.split(".lev")[1]
+        else:
+            self.datatype = "SDA"
+            self.level = file.split(".ONEILL_")[1]
+
+        if "all_points" in file:
+            self.freq = "Point"
+        elif "series" in file:
+            self.freq = "Series"
+        elif "daily" in file:
+            self.freq = "Daily"
+        else:
+            self.freq = None
+
+        self.source_columns = [
+            col.replace("(int)", "") for col in lines[4].strip().split(",")
+        ]
+        translate = sda_dict if self.datatype == "SDA" else aod_dict
+        self.columns = [translate.get(col, col) for col in self.source_columns]
+        self.schema = man_schema(self.columns)
+
+    def batches(self):
+        reader = pa_csv.open_csv(
+            self.file,
+            read_options=pa_csv.ReadOptions(
+                skip_rows=HEADER_LINES,
+                column_names=self.columns,
+                block_size=self.block_size,
+                encoding="latin-1",
+            ),
+            convert_options=pa_csv.ConvertOptions(column_types=self.schema),
+        )
+        for batch in reader:
+            yield parse_dates(batch)
+
+    def frames(self):
+        for batch in self.batches():
+            yield batch.to_pandas(types_mapper={pa.int32(): pd.Int32Dtype()}.get)
+
+
+def parse_date_column(column):
+    parsed = pc.strptime(
+        column, format=SOURCE_DATE_FORMAT, unit="s", error_is_null=True
+    )
+    # strptime rolls impossible dates over ("31:02:2010" -> 2010-03-03); any
+    # value that does not print back the same is parsed again by pandas,
+    # which turns those into null and still accepts unpadded days and months.
+    retry = pc.fill_null(
+        pc.not_equal(pc.strftime(parsed, format=SOURCE_DATE_FORMAT), column), False
+    )
+    if pc.any(retry).as_py():
+        indices = np.flatnonzero(retry.to_numpy(zero_copy_only=False))
+        dates = pd.to_datetime(
+            pd.Series(column.take(indices).to_pylist(), dtype=object),
+            format=SOURCE_DATE_FORMAT,
+            errors="coerce",
+        )
+        values = parsed.to_pandas()
+        values.iloc[indices] = dates.to_numpy(dtype="datetime64[s]")
+        parsed = pa.array(values, type=parsed.type)
+    return parsed.cast(pa.date32())
+
+
+def parse_dates(batch):
+    columns = []
+    for name, column in zip(batch.schema.names, batch.columns):
+        if name in DATE_COLUMNS:
+            column = parse_date_column(column)
+        columns.append(column)
+    return pa.RecordBatch.from_arrays(columns, names=batch.schema.names)
+
+
+def prepare_frame(df, man, coordinates="geos", wkt=False):
+    # Shapes a typed frame from ManFile.frames() into the column layout of the
+    # maritimeapp_download* tables.
+    lng = df["Longitude"].to_numpy(dtype="f8")
+    lat = df["Latitude"].to_numpy(dtype="f8")
+    if coordinates == "geos":
+        df["coordinates"] = [Point(x, y) for x, y in zip(lng, lat)]
+    else:
+        df["coordinates"] = encode_points(lng, lat, coordinates)
+    # coordinates_wkt is what download CSVs show, so it is never EWKB.
+    if wkt or coordinates != "geos":
+        df["coordinates_wkt"] = points_to_wkt(lng, lat)
+    else:
+        df["coordinates_wkt"] = df["coordinates"]
+    df = df.drop(columns=["Longitude", "Latitude"])
+    df["cruise"] = man.cruise
+    df["level"] = man.level
+    df["pi"] = man.pi
+    df["pi_email"] = man.pi_email
+    return df
+
+
+MAN_FILE_ENDINGS = [
+    "all_points.lev10",
+    "all_points.lev15",
+    "all_points.lev20",
+    "series.lev15",
+    "series.lev20",
+    "daily.lev15",
+    "daily.lev20",
+    "all_points.ONEILL_10",
+    "all_points.ONEILL_15",
+    "all_points.ONEILL_20",
+    "series.ONEILL_15",
+    "series.ONEILL_20",
+    "daily.ONEILL_15",
+    "daily.ONEILL_20",
+]
+
+TABLE_NAMES = {
+    ("AOD", "Point"): "maritimeapp_downloadaodap",
+    ("AOD", "Series"): "maritimeapp_downloadaodseries",
+    ("AOD", "Daily"): "maritimeapp_downloadaoddaily",
+    ("SDA", "Point"): "maritimeapp_downloadsdaap",
+    ("SDA", "Series"): "maritimeapp_downloadsdaseries",
+    ("SDA", "Daily"): "maritimeapp_downloadsdadaily",
+}
+
+
+def is_man_data_file(name):
+    return name.endswith(tuple(MAN_FILE_ENDINGS))
+
+
+def archive_validator(response):
+    # If-Range takes a strong ETag or a Last-Modified date.
+    etag = response.headers.get("ETag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return response.headers.get("Last-Modified")
+
+
+def content_range(response):
+    """(first byte, total size) of a Content-Range header; None if unknown."""
+    match = re.fullmatch(
+        r"bytes (?:(\d+)-\d+|\*)/(\d+|\*)",
+        response.headers.get("Content-Range", "").strip(),
+    )
+    if match is None:
+        return None, None
+    first, total = match.groups()
+    return (
+        None if first is None else int(first),
+        None if total == "*" else int(total),
+    )
+
+
+def download_archive(url, path, chunk_size=1 << 20, timeout=60):
+    """
+    Stream url to path. The download goes to path + ".part" first, and an
+    interrupted download is resumed from there with a Range request. The
+    resume sends If-Range with the ETag (or Last-Modified) of the first
+    response, so an archive regenerated in between is fetched again from the
+    start instead of being spliced onto the old prefix.
+    """
+    partial = path + ".part"
+    validator_path = partial + ".validator"
+    offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+    validator = None
+    if offset and os.path.exists(validator_path):
+        with open(validator_path) as f:
+            validator = f.read().strip() or None
+    # A prefix that cannot be validated is not resumed.
+    headers = {"Range": f"bytes={offset}-", "If-Range": validator} if validator else {}
+
+    def restart():
+        for name in (partial, validator_path):
+            if os.path.exists(name):
+                os.remove(name)
+        return download_archive(url, path, chunk_size, timeout)
+
+    with requests.get(url, headers=headers, stream=True, timeout=timeout) as response:
+        if response.status_code == 416:
+            if not headers:
+                return False
+            # Nothing past offset: done only if the archive is that long.
+            if content_range(response)[1] == offset:
+                os.replace(partial, path)
+                os.remove(validator_path)
+                return True
+            return restart()
+        if not response.ok:
+            return False
+        if headers and response.status_code == 206:
+            if content_range(response)[0] != offset:
+                return restart()
+            mode = "ab"
+        else:
+            # A fresh download, or a 200 to the ranged request: the archive
+            # changed (or Range is not supported), start over.
+            mode = "wb"
+            with open(validator_path, "w") as f:
+                f.write(archive_validator(response) or "")
+        expected = response.headers.get("Content-Length")
+        written = 0
+        with open(partial, mode) as f:
+            for chunk in response.iter_content(chunk_size):
+                f.write(chunk)
+                written += len(chunk)
+
+    if expected is not None and written < int(expected):
+        return False
+    os.replace(partial, path)
+    os.remove(validator_path)
+    return True
+
+
+def extract_man_files(archive, dest, policy_dest=None):
+    """
+    Read a MAN tarball member by member and write only the MAN data files,
+    flattened, into dest (and the data usage policy into policy_dest, if
+    given). Returns the number of data files written.
+    """
+    os.makedirs(dest, exist_ok=True)
+    if policy_dest is not None:
+        os.makedirs(policy_dest, exist_ok=True)
+    count = 0
+    with tarfile.open(archive, mode="r|gz") as tar:
+        for member in tar:
+            name = os.path.basename(member.name)
+            if not member.isfile():
+                continue
+            if is_man_data_file(name):
+                folder = dest
+                count += 1
+            elif policy_dest is not None and name in POLICY_FILES:
+                folder = policy_dest
+            else:
+                continue
+            source = tar.extractfile(member)
+            with open(os.path.join(folder, name), "wb") as f:
+                shutil.copyfileobj(source, f, BLOCK_SIZE)
+    return count
+
+
+def fetch_man_data(dest, url=MAN_ARCHIVE_URL, policy_dest=None):
+    """
+    Download the MAN archive next to dest and replace dest with its data
+    files, so files withdrawn upstream do not linger. Returns the number of
+    files extracted, or None if the download failed (a partial download is
+    kept and resumed on the next call).
+    """
+    archive = os.path.join(
+        os.path.dirname(os.path.abspath(dest)), os.path.basename(url)
+    )
+    try:
+        if not download_archive(url, archive):
+            return None
+    except requests.RequestException as e:
+        print(f"Download failed: {e}")
+        return None
+    # Extract next to dest and swap it in, so dest holds exactly the archive.
+    dest = os.path.abspath(dest)
+    fresh = dest + ".new"
+    shutil.rmtree(fresh, ignore_errors=True)
+    if policy_dest is not None and os.path.abspath(policy_dest) == dest:
+        policy_dest = fresh
+    try:
+        count = extract_man_files(archive, fresh, policy_dest)
+    except BaseException:
+        shutil.rmtree(fresh, ignore_errors=True)
+        raise
+    finally:
+        os.remove(archive)
+    shutil.rmtree(dest, ignore_errors=True)
+    os.replace(fresh, dest)
+    return count
+
+
+class CsvEncoder:
+    header = b""
+    trailer = b""
+
+    def encode(self, df):
+        return df.to_csv(index=False, header=False).encode("utf-8")
+
+
+class FrameStream:
+    """
+    Read-only file object that encodes frames on demand (CSV by default), so
+    a generator of frames can be handed straight to cursor.copy_expert.
+    """
+
+    def __init__(self, frames, encoder=None):
+        self.frames = iter(frames)
+        self.encoder = encoder or CsvEncoder()
+        self.columns = None
+        self.first_row = None
+        self.rows = 0
+        self.buffer = self.encoder.header
+        self.bytes = len(self.buffer)
+        self.pos = 0
+        self.finished = False
+
+    def peek_columns(self):
+        # COPY needs the column list before the first read.
+        if self.columns is None:
+            self._fill()
+        return self.columns
+
+    def _fill(self):
+        if self.finished:
+            return False
+        df = next(self.frames, None)
+        if df is None:
+            self.finished = True
+            chunk = self.encoder.trailer
+        else:
+            if self.columns is None:
+                self.columns = list(df.columns)
+                self.first_row = df.iloc[0]
+            chunk = self.encoder.encode(df)
+            self.rows += len(df)
+        self.bytes += len(chunk)
+        self.buffer = self.buffer[self.pos :] + chunk
+        self.pos = 0
+        return True
+
+    def read(self, size=-1):
+        while self.pos >= len(self.buffer):
+            if not self._fill():
+                return b""
+        if size is None or size < 0:
+            end = len(self.buffer)
+        else:
+            end = self.pos + size
+        data = self.buffer[self.pos : end]
+        self.pos += len(data)
+        return data
+
+
+# PostgreSQL binary COPY framing, see
+# https://www.postgresql.org/docs/current/sql-copy.html#id-1.9.3.55.9.4
+PGCOPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+PGCOPY_TRAILER = struct.pack(">h", -1)
+PG_EPOCH = np.datetime64("2000-01-01", "D")
+NULL_FIELD = struct.pack(">i", -1)
+
+
+def _pack_fixed(values, null, fmt):
+    # Length-prefixed fixed-width fields for a whole column in one pass.
+    packed = np.empty(len(values), dtype=[("length", ">i4"), ("value", fmt)])
+    packed["length"] = np.dtype(fmt).itemsize
+    packed["value"] = values
+    fields = np.frombuffer(packed.tobytes(), dtype=f"V{packed.dtype.itemsize}").tolist()
+    for i in np.flatnonzero(null):
+        fields[i] = NULL_FIELD
+    return fields
+
+
+def encode_float8(series):
+    values = pd.to_numeric(series, errors="coerce").to_numpy(
+        dtype="f8", na_value=np.nan
+    )
+    return _pack_fixed(values, np.isnan(values), ">f8")
+
+
+def encode_int4(series):
+    values = pd.to_numeric(series, errors="coerce")
+    null = values.isna().to_numpy()
+    return _pack_fixed(values.fillna(0).to_numpy(dtype="i4"), null, ">i4")
+
+
+def encode_date(series):
+    dates = pd.to_datetime(series, format="%Y-%m-%d", errors="coerce")
+    null = dates.isna().to_numpy()
+    days = dates.to_numpy(dtype="datetime64[D]") - PG_EPOCH
+    return _pack_fixed(np.where(null, 0, days.astype("i8")), null, ">i4")
+
+
+def encode_time(series):
+    times = pd.to_timedelta(series, errors="coerce")
+    null = times.isna().to_numpy()
+    micros = times.to_numpy(dtype="timedelta64[us]").astype("i8")
+    return _pack_fixed(np.where(null, 0, micros), null, ">i8")
+
+
+def encode_text(series):
+    fields = []
+    for value, null in zip(series.tolist(), series.isna().to_numpy()):
+        if null:
+            fields.append(NULL_FIELD)
+        else:
+            data = str(value).encode("utf-8")
+            fields.append(struct.pack(">i", len(data)) + data)
+    return fields
+
+
+def parse_points(series):
+    # Accepts the hex EWKB import_dd writes with --coordinates ewkb, or any
+    # "[SRID=n;]POINT (x y)" text.
+    values = series.astype(str)
+    if len(values) and re.fullmatch(r"[0-9A-Fa-f]+", values.iloc[0]):
+        raw = bytes.fromhex("".join(values))
+        if len(raw) != len(values) * EWKB_POINT.itemsize:
+            raise ValueError("coordinates are not uniform EWKB points")
+        points = np.frombuffer(raw, dtype=EWKB_POINT)
+        return points["x"], points["y"]
+    coords = values.str.extract(r"POINT\s*\(\s*(\S+)\s+([^\s)]+)\s*\)")
+    return coords[0].astype("f8").to_numpy(), coords[1].astype("f8").to_numpy()
+
+
+def encode_geometry(series):
+    lng, lat = parse_points(series)
+    packed = np.empty(len(lng), dtype=[("length", ">i4"), ("point", EWKB_POINT)])
+    packed["length"] = EWKB_POINT.itemsize
+    packed["point"] = points_to_ewkb(lng, lat)
+    return np.frombuffer(packed.tobytes(), dtype=f"V{packed.dtype.itemsize}").tolist()
+
+
+def field_encoder(field):
+    if isinstance(field, gis_models.PointField):
+        return encode_geometry
+    if isinstance(field, models.IntegerField):
+        return encode_int4
+    if isinstance(field, models.FloatField):
+        return encode_float8
+    if isinstance(field, models.DateField):
+        return encode_date
+    if isinstance(field, models.TimeField):
+        return encode_time
+    return encode_text
+
+
+class BinaryCopyEncoder:
+    """
+    Encodes frames whose columns match ``model`` fields into PostgreSQL's
+    binary COPY format.
+    """
+
+    header = PGCOPY_HEADER
+    trailer = PGCOPY_TRAILER
+
+    def __init__(self, model, columns):
+        self.columns = list(columns)
+        self.encoders = [field_encoder(model._meta.get_field(c)) for c in columns]
+        self.field_count = struct.pack(">h", len(self.columns))
+
+    def encode(self, df):
+        fields = [
+            encode(df[column]) for column, encode in zip(self.columns, self.encoders)
+        ]
+        rows = zip(repeat(self.field_count, len(df)), *fields)
+        return b"".join(chain.from_iterable(rows))
+
+
+def file_fingerprint(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+            size += len(chunk)
+    return size, digest.hexdigest()
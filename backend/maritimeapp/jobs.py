@@ -0,0 +1,178 @@
+"""
+Background download jobs. Jobs are rows in DownloadJob; any number of
+download_worker threads or processes claim them with SELECT ... FOR UPDATE
+SKIP LOCKED, so Postgres is the only coordination needed.
+
+A running job's started_at is its lease: the worker renews it while the job
+runs, and a job whose lease has lapsed (its worker died) is claimed again.
+"""
+
+import glob
+import os
+import threading
+import time
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .export import archive_entries, stream_zip
+from .models import DownloadJob
+
+
+def submit(params):
+    return DownloadJob.objects.create(
+        params=params, filename=f"{int(time.time())}_MAN_DATA.zip"
+    )
+
+
+def describe(job):
+    return {
+        "id": str(job.pk),
+        "status": job.status,
+        "files_total": job.files_total,
+        "files_done": job.files_done,
+        "rows_written": job.rows_written,
+        "error": job.error,
+        "created_at": job.created_at,
+        "finished_at": job.finished_at,
+        "expires_at": job.expires_at,
+    }
+
+
+def claim():
+    """
+    Mark the oldest queued job, or running job whose lease has lapsed, as
+    running and return it, or None.
+    """
+    lapsed = timezone.now() - timedelta(seconds=settings.DOWNLOAD_JOB_LEASE)
+    with transaction.atomic():
+        job = (
+            DownloadJob.objects.select_for_update(skip_locked=True)
+            .filter(
+                Q(status=DownloadJob.QUEUED)
+                | Q(status=DownloadJob.RUNNING, started_at__lt=lapsed)
+            )
+            .order_by("created_at")
+            .first()
+        )
+        if job is None:
+            return None
+        job.status = DownloadJob.RUNNING
+        job.started_at = timezone.now()
+        job.files_total = job.files_done = job.rows_written = 0
+        job.save(
+            update_fields=[
+                "status",
+                "started_at",
+                "files_total",
+                "files_done",
+                "rows_written",
+            ]
+        )
+    return job
+
+
+def leased(job):
+    # The job's row, for as long as this worker holds its lease.
+    return DownloadJob.objects.filter(
+        pk=job.pk, status=DownloadJob.RUNNING, started_at=job.started_at
+    )
+
+
+def heartbeat(job, lock, stop):
+    # Runs in its own thread, so it gets (and must close) its own connection.
+    try:
+        while not stop.wait(settings.DOWNLOAD_JOB_LEASE / 4):
+            with lock:
+                now = timezone.now()
+                if not leased(job).update(started_at=now):
+                    return
+                job.started_at = now
+    finally:
+        connection.close()
+
+
+def run(job):
+    folder = job.filename[: -len(".zip")]
+    path = os.path.join(settings.DOWNLOAD_JOBS_DIR, f"{job.pk}.zip")
+    # Per claim, so a worker that lost the lease cannot write into the file
+    # of the one that took over.
+    part = f"{path}.{uuid.uuid4().hex}.part"
+    os.makedirs(settings.DOWNLOAD_JOBS_DIR, exist_ok=True)
+
+    lock = threading.Lock()
+    stop = threading.Event()
+    beat = threading.Thread(target=heartbeat, args=(job, lock, stop), daemon=True)
+    beat.start()
+
+    def progress(arcname, rows):
+        with lock:
+            leased(job).update(
+                files_done=F("files_done") + 1, rows_written=F("rows_written") + rows
+            )
+
+    try:
+        files, entries = archive_entries(job.params, folder, progress)
+        with lock:
+            leased(job).update(files_total=files)
+        with open(part, "wb") as f:
+            for chunk in stream_zip(entries):
+                f.write(chunk)
+        os.replace(part, path)
+    except Exception as e:
+        if os.path.exists(part):
+            os.remove(part)
+        stop.set()
+        beat.join()
+        leased(job).update(
+            status=DownloadJob.FAILED, error=str(e), finished_at=timezone.now()
+        )
+        return False
+
+    stop.set()
+    beat.join()
+    finished = timezone.now()
+    leased(job).update(
+        status=DownloadJob.DONE,
+        path=path,
+        finished_at=finished,
+        expires_at=finished + timedelta(seconds=settings.DOWNLOAD_JOB_TTL),
+    )
+    return True
+
+
+def expire():
+    """
+    Delete jobs past their TTL with their archives, and the partial archives
+    of workers that died.
+    """
+    now = timezone.now()
+    expired = DownloadJob.objects.filter(
+        Q(status=DownloadJob.DONE, expires_at__lte=now)
+        | Q(
+            status__in=[DownloadJob.FAILED, DownloadJob.EXPIRED],
+            finished_at__lte=now - timedelta(seconds=settings.DOWNLOAD_JOB_TTL),
+        )
+    )
+    count = 0
+    for job in expired:
+        if job.path:
+            try:
+                os.remove(job.path)
+            except FileNotFoundError:
+                pass
+        DownloadJob.objects.filter(pk=job.pk).delete()
+        count += 1
+
+    stale = time.time() - settings.DOWNLOAD_JOB_TTL
+    for part in glob.glob(os.path.join(settings.DOWNLOAD_JOBS_DIR, "*.part")):
+        try:
+            if os.path.getmtime(part) < stale:
+                os.remove(part)
+        except FileNotFoundError:
+            pass
+    return count
@@ -0,0 +1,293 @@
+import os
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+from django.apps import apps
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from maritimeapp.ingest import (
+    COORDINATE_ENCODINGS,
+    DATE_COLUMNS,
+    INT_COLUMNS,
+    MAN_FILE_ENDINGS,
+    TABLE_NAMES,
+    aod_dict,
+    sda_dict,
+)
+from maritimeapp.models import IngestLedger, Site, TableHeader
+
+MANAGE_PY = os.path.join(settings.BASE_DIR, "manage.py")
+
+
+def variant_of(ending):
+    datatype = "AOD" if ".lev" in ending else "SDA"
+    if ending.startswith("all_points"):
+        freq = "Point"
+    elif ending.startswith("series"):
+        freq = "Series"
+    else:
+        freq = "Daily"
+    level = ending.split(".lev")[1] if datatype == "AOD" else ending.split("_")[-1]
+    return datatype, freq, level
+
+
+def model_for(datatype, freq):
+    table_name = TABLE_NAMES[(datatype, freq)]
+    for model in apps.get_app_config("maritimeapp").get_models():
+        if model._meta.db_table == table_name:
+            return model
+
+
+def source_columns(datatype, freq):
+    # The source header of a MAN file, rebuilt from the model it loads into.
+    translate = sda_dict if datatype == "SDA" else aod_dict
+    source = {field: col for col, field in translate.items()}
+    columns = [
+        source[field.name]
+        for field in model_for(datatype, freq)._meta.concrete_fields
+        if field.name in source
+    ]
+    anchor = "Air_Mass" if datatype == "SDA" else "Air Mass"
+    if anchor not in columns:
+        anchor = "Time(hh:mm:ss)"
+    position = columns.index(anchor) + 1
+    columns[position:position] = ["Latitude", "Longitude"]
+    return columns
+
+
+def synthetic_frame(columns, datatype, rows, rng):
+    translate = sda_dict if datatype == "SDA" else aod_dict
+    days = np.datetime64("2004-01-01") + np.sort(rng.integers(0, 7000, rows))
+    dates = pd.Series(pd.to_datetime(days).strftime("%d:%m:%Y"))
+    data = {}
+    for col in columns:
+        field = translate.get(col)
+        if field in DATE_COLUMNS:
+            data[col] = dates
+        elif field == "time_HH_MM_SS":
+            seconds = rng.integers(0, 86400, rows)
+            data[col] = pd.Series(
+                [f"{s // 3600:02d}:{s // 60 % 60:02d}:{s % 60:02d}" for s in seconds]
+            )
+        elif col == "Latitude":
+            data[col] = np.round(rng.uniform(-80, 80, rows), 6)
+        elif col == "Longitude":
+            data[col] = np.round(rng.uniform(-180, 180, rows), 6)
+        elif field in INT_COLUMNS:
+            data[col] = rng.integers(1, 500, rows)
+        else:
+            values = np.round(rng.uniform(0, 2, rows), 6)
+            values[rng.random(rows) < 0.1] = -999.0
+            data[col] = values
+    return pd.DataFrame(data, columns=columns)
+
+
+def write_man_file(path, cruise, ending, rows, rng):
+    datatype, freq, level = variant_of(ending)
+    columns = source_columns(datatype, freq)
+    with open(path, "w", encoding="latin-1") as f:
+        f.write(
+            f"AERONET Version 3; Maritime Aerosol Network (MAN) {datatype} "
+            f"Level {level[0]}.{level[1]} {freq} (synthetic)\n"
+        )
+        f.write(f"{cruise},synthetic\n")
+        f.write("Synthetic benchmark data, not for use.\n")
+        f.write("PI=Bench Mark,Email=bench@example.com\n")
+        synthetic_frame(columns, datatype, rows, rng).to_csv(
+            f, index=False, lineterminator="\n"
+        )
+    return rows
+
+
+def generate_man_files(folder, cruises, rows, seed=0):
+    """
+    Write one synthetic MAN file per cruise for every variant in
+    MAN_FILE_ENDINGS. Returns the total number of data rows written.
+    """
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    total = 0
+    for n in range(cruises):
+        cruise = f"Bench_{n:03d}"
+        for ending in MAN_FILE_ENDINGS:
+            total += write_man_file(
+                os.path.join(folder, f"{cruise}_{ending}"), cruise, ending, rows, rng
+            )
+    return total
+
+
+def folder_size(folder):
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, files in os.walk(folder)
+        for name in files
+    )
+
+
+def database_size():
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_database_size(current_database())")
+        return cursor.fetchone()[0]
+
+
+def stage_env(workdir):
+    # Export fragments, the archive cache and its ingest generation go under
+    # workdir: psql_add rebuilds fragments and bumps the generation, which
+    # must neither touch the real ones nor escape MB_written.
+    env = dict(os.environ)
+    for name, folder in [
+        ("DJANGO_DOWNLOAD_CACHE_DIR", "download_cache"),
+        ("DJANGO_DOWNLOAD_FRAGMENTS_DIR", "download_fragments"),
+        ("DJANGO_DOWNLOAD_JOBS_DIR", "download_jobs"),
+    ]:
+        env[name] = os.path.join(os.path.abspath(workdir), folder)
+    env["DJANGO_RESULT_CACHE_DIR"] = ""
+    return env
+
+
+class Command(BaseCommand):
+    help = (
+        "Generate synthetic MAN files and time import_dd, psql_add (which "
+        "includes writing the export fragments) and update_dates on them. Runs "
+        "offline against the configured database; files, fragments and caches "
+        "stay in the work directory."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--rows", type=int, default=10_000, help="Data rows per MAN file."
+        )
+        parser.add_argument(
+            "--cruises",
+            type=int,
+            default=2,
+            help="Cruises to generate; each gets all 14 file variants.",
+        )
+        parser.add_argument(
+            "--workdir",
+            help="Where to write src_csvs (default: a new temporary directory).",
+        )
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument(
+            "--workers", type=int, default=1, help="Passed to import_dd."
+        )
+        parser.add_argument("--jobs", type=int, default=1, help="Passed to psql_add.")
+        parser.add_argument(
+            "--coordinates",
+            choices=COORDINATE_ENCODINGS,
+            default="ewkb",
+            help="Passed to import_dd.",
+        )
+        parser.add_argument(
+            "--binary", action="store_true", help="Pass --binary to psql_add."
+        )
+        parser.add_argument(
+            "--reset",
+            action="store_true",
+            help="Truncate the download, site and header tables first.",
+        )
+
+    def handle(self, *args, **kwargs):
+        tables = list(TABLE_NAMES.values())
+        if kwargs["reset"]:
+            self.truncate(tables)
+        elif Site.objects.exists() or any(
+            model_for(*key).objects.exists() for key in TABLE_NAMES
+        ):
+            raise CommandError(
+                "The MAN tables are not empty; use --reset against a benchmark "
+                "database."
+            )
+
+        workdir = kwargs["workdir"] or tempfile.mkdtemp(prefix="man_bench_")
+        os.makedirs(workdir, exist_ok=True)
+        # The settings read config.ini from the working directory.
+        config = os.path.abspath("config.ini")
+        if os.path.exists(config) and not os.path.exists(
+            os.path.join(workdir, "config.ini")
+        ):
+            os.symlink(config, os.path.join(workdir, "config.ini"))
+
+        csv_folder = os.path.join(workdir, "src_csvs")
+        start = time.perf_counter()
+        rows = generate_man_files(
+            csv_folder, kwargs["cruises"], kwargs["rows"], kwargs["seed"]
+        )
+        self.stdout.write(
+            f"Generated {rows} rows ({folder_size(csv_folder) / 1e6:.1f} MB) in "
+            f"{csv_folder} in {time.perf_counter() - start:.1f}s"
+        )
+
+        load_args = ["--jobs", str(kwargs["jobs"])]
+        if kwargs["binary"]:
+            load_args.append("--binary")
+        stages = [
+            (
+                "import_dd",
+                rows,
+                [
+                    "--workers",
+                    str(kwargs["workers"]),
+                    "--coordinates",
+                    kwargs["coordinates"],
+                    "--wkt",
+                ],
+            ),
+            ("psql_add", rows, load_args),
+            ("update_dates", kwargs["cruises"], []),
+        ]
+        results = [self.run_stage(workdir, *stage) for stage in stages]
+
+        self.stdout.write("stage,rows,seconds,rows/s,peak_rss_MB,MB_written")
+        for stage, stage_rows, seconds, rss, written in results:
+            self.stdout.write(
+                f"{stage},{stage_rows},{seconds:.2f},"
+                f"{stage_rows / (seconds or float('nan')):.0f},"
+                f"{rss / 1024:.1f},{written / 1e6:.1f}"
+            )
+
+    def truncate(self, tables):
+        tables = tables + [
+            Site._meta.db_table,
+            TableHeader._meta.db_table,
+            IngestLedger._meta.db_table,
+        ]
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "TRUNCATE {}".format(", ".join(map(connection.ops.quote_name, tables)))
+            )
+
+    def run_stage(self, workdir, stage, rows, stage_args):
+        # Each stage runs in its own process so wait4 reports its peak RSS
+        # (including any worker processes it reaped) on its own.
+        command = [sys.executable, MANAGE_PY, stage, *stage_args]
+        self.stdout.write(f"Running {shlex.join(command)}")
+        files_before = folder_size(workdir)
+        db_before = database_size()
+
+        start = time.perf_counter()
+        with open(os.path.join(workdir, f"{stage}.log"), "w") as log:
+            process = subprocess.Popen(
+                command,
+                cwd=workdir,
+                env=stage_env(workdir),
+                stdout=log,
+                stderr=subprocess.STDOUT,
+            )
+            _, status, usage = os.wait4(process.pid, 0)
+            process.returncode = os.waitstatus_to_exitcode(status)
+        seconds = time.perf_counter() - start
+        if process.returncode:
+            raise CommandError(
+                f"{stage} exited with {process.returncode}, see {log.name}"
+            )
+
+        written = folder_size(workdir) - files_before + database_size() - db_before
+        return stage, rows, seconds, usage.ru_maxrss, max(written, 0)
@@ -0,0 +1,23 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+
+class Command(BaseCommand):
+    help = (
+        "Create the tables of maritimeapp models that are missing from the "
+        "database. reset_db.sh fakes the maritimeapp migrations, so models "
+        "added since the tables were first created are not built by migrate."
+    )
+
+    def handle(self, *args, **kwargs):
+        existing = set(connection.introspection.table_names())
+        created = 0
+        with connection.schema_editor() as editor:
+            for model in apps.get_app_config("maritimeapp").get_models():
+                if not model._meta.managed or model._meta.db_table in existing:
+                    continue
+                editor.create_model(model)
+                created += 1
+                self.stdout.write(f"Created {model._meta.db_table}")
+        self.stdout.write(self.style.SUCCESS(f"Created {created} missing tables"))
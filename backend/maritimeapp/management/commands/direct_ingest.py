@@ -0,0 +1,311 @@
+import glob
+import os
+import time
+
+import pandas as pd
+import psycopg2
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from psycopg2 import sql
+
+from maritimeapp.cache import bump_ingest_generation
+from maritimeapp.export import (
+    build_fragments,
+    invalidate_fragments,
+    mark_fragments_ready,
+)
+from maritimeapp.ingest import (
+    COORDINATE_ENCODINGS,
+    MAN_ARCHIVE_URL,
+    TABLE_NAMES,
+    FrameStream,
+    ManFile,
+    file_fingerprint,
+    is_man_data_file,
+    prepare_frame,
+)
+from maritimeapp.management.commands.import_dd import (
+    download_folder_path,
+    download_man_data,
+    log_filename,
+)
+from maritimeapp.management.commands.psql_add import DB_PARAMS
+from maritimeapp.models import IngestLedger, Site, TableHeader
+
+
+def delete_rows(cursor, datatype, freq, cruise, level):
+    cursor.execute(
+        sql.SQL("DELETE FROM {} WHERE cruise = %s AND level = %s").format(
+            sql.Identifier(TABLE_NAMES[(datatype, freq)])
+        ),
+        [cruise, int(level)],
+    )
+
+
+def truncate_tables(conn):
+    with conn.cursor() as cursor:
+        cursor.execute(
+            sql.SQL("TRUNCATE {}").format(
+                sql.SQL(", ").join(
+                    map(
+                        sql.Identifier,
+                        [*TABLE_NAMES.values(), IngestLedger._meta.db_table],
+                    )
+                )
+            )
+        )
+    conn.commit()
+
+
+def track_last_processing_date(frames, latest):
+    # Passes frames through, keeping the newest Last_Processing_Date in latest[0].
+    for df in frames:
+        value = df["last_processing_date_DD_MM_YYYY"].max()
+        if not pd.isna(value) and (latest[0] is None or value > latest[0]):
+            latest[0] = value
+        yield df
+
+
+class Command(BaseCommand):
+    help = (
+        "Parse MAN files and COPY them straight into the download tables, "
+        "without writing intermediate CSVs."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--folder",
+            default=download_folder_path,
+            help="Directory holding the extracted MAN archive (default: ./src).",
+        )
+        parser.add_argument(
+            "--coordinates",
+            choices=[c for c in COORDINATE_ENCODINGS if c != "geos"],
+            default="ewkb",
+            help="Encoding used for the coordinates column (default: ewkb).",
+        )
+        parser.add_argument(
+            "--url",
+            default=MAN_ARCHIVE_URL,
+            help="Where to download the MAN archive from.",
+        )
+        parser.add_argument(
+            "--download",
+            action="store_true",
+            help="Fetch and extract the MAN archive even if --folder exists.",
+        )
+        parser.add_argument(
+            "--incremental",
+            action="store_true",
+            help="Only reload files whose size or hash differs from the ingest "
+            "ledger, replacing that cruise/level in place.",
+        )
+
+    def handle(self, *args, **kwargs):
+        folder = kwargs["folder"]
+        incremental = kwargs["incremental"]
+        if kwargs["download"] or not os.path.exists(folder):
+            print("Downloading man data.")
+            if not download_man_data(folder, kwargs["url"]):
+                return
+
+        files = sorted(
+            file
+            for file in glob.glob(os.path.join(folder, "**", "*"), recursive=True)
+            if os.path.isfile(file) and is_man_data_file(file)
+        )
+        ledger = {entry.source_file: entry for entry in IngestLedger.objects.all()}
+
+        invalidate_fragments()
+        conn = psycopg2.connect(**DB_PARAMS)
+        stats = {}
+        headers = {}
+        sites = {}
+        changed = set()
+        fragments = set()
+        skipped = 0
+        try:
+            if not incremental:
+                # A full run reloads everything; appending would duplicate rows.
+                truncate_tables(conn)
+                ledger = {}
+            for file in files:
+                source_file = os.path.basename(file)
+                size, sha256 = file_fingerprint(file)
+                previous = ledger.pop(source_file, None)
+                if (
+                    incremental
+                    and previous is not None
+                    and (previous.size, previous.sha256) == (size, sha256)
+                ):
+                    skipped += 1
+                    continue
+
+                loaded = self.load_file(
+                    conn,
+                    file,
+                    kwargs["coordinates"],
+                    stats,
+                    previous=previous,
+                    replace=incremental,
+                )
+                if loaded is None:
+                    continue
+                man, stream, last_processing_date = loaded
+                fragments.add((man.datatype, man.freq, int(man.level), man.cruise))
+                if previous is not None:
+                    fragments.add(
+                        (
+                            previous.datatype,
+                            previous.freq,
+                            previous.level,
+                            previous.cruise,
+                        )
+                    )
+                IngestLedger.objects.update_or_create(
+                    source_file=source_file,
+                    defaults={
+                        "cruise": man.cruise,
+                        "datatype": man.datatype,
+                        "freq": man.freq,
+                        "level": int(man.level),
+                        "size": size,
+                        "sha256": sha256,
+                        "last_processing_date": last_processing_date,
+                        "rows": stream.rows,
+                    },
+                )
+                headers.setdefault(
+                    (man.freq, man.datatype, man.level),
+                    (man.header_lines[0], man.header_lines[2]),
+                )
+                if man.freq == "Daily" and man.datatype == "AOD" and man.level == "15":
+                    number = stream.first_row["aeronet_number"]
+                    sites.setdefault(man.cruise, 0 if pd.isna(number) else int(number))
+                    changed.add(man.cruise)
+                    if previous is not None:
+                        changed.add(previous.cruise)
+
+            if incremental:
+                # Files still left in the ledger have been dropped upstream.
+                for entry in ledger.values():
+                    with conn.cursor() as cursor:
+                        delete_rows(
+                            cursor,
+                            entry.datatype,
+                            entry.freq,
+                            entry.cruise,
+                            entry.level,
+                        )
+                    conn.commit()
+                    entry.delete()
+                    fragments.add(
+                        (entry.datatype, entry.freq, entry.level, entry.cruise)
+                    )
+                    self.stdout.write(f"Removed {entry.source_file}")
+                    changed.add(entry.cruise)
+        except BaseException:
+            # Files loaded before the failure are committed already.
+            bump_ingest_generation()
+            raise
+        finally:
+            conn.close()
+
+        for (freq, datatype, level), (l1, l2) in headers.items():
+            # One header per variant (unique_dataType_level): a changed header
+            # replaces the stored one.
+            TableHeader.objects.update_or_create(
+                freq=freq,
+                datatype=datatype,
+                level=level,
+                defaults={"base_header_l1": l1, "base_header_l2": l2},
+            )
+
+        Site.objects.bulk_create(
+            [
+                Site(name=name, aeronet_number=number, description="?", span_date=[])
+                for name, number in sites.items()
+            ],
+            ignore_conflicts=True,
+        )
+        if incremental:
+            self.stdout.write(f"Skipped {skipped} unchanged files")
+            Site.update_span_dates(changed)
+        else:
+            call_command("update_dates")
+
+        # The new rows are live: retire cached archives and results now rather
+        # than once the fragments are rebuilt.
+        generation = bump_ingest_generation()
+        written = build_fragments(fragments if incremental else None)
+        self.stdout.write(f"Wrote {written} export fragments")
+        mark_fragments_ready(generation)
+        self.report(stats)
+
+    def load_file(self, conn, file, coordinates, stats, previous=None, replace=False):
+        try:
+            man = ManFile(file)
+            table_name = TABLE_NAMES[(man.datatype, man.freq)]
+            latest = [None]
+            stream = FrameStream(
+                prepare_frame(df, man, coordinates, wkt=True)
+                for df in track_last_processing_date(man.frames(), latest)
+            )
+            columns = stream.peek_columns()
+            if columns is None:
+                raise ValueError("no data rows")
+            copy_query = sql.SQL("COPY {} ({}) FROM STDIN WITH CSV").format(
+                sql.Identifier(table_name),
+                sql.SQL(",").join(map(sql.Identifier, columns)),
+            )
+
+            start = time.perf_counter()
+            with conn.cursor() as cursor:
+                # The old rows are deleted in the same transaction as the COPY,
+                # so readers never see the cruise missing.
+                if replace:
+                    delete_rows(cursor, man.datatype, man.freq, man.cruise, man.level)
+                    if previous is not None and (
+                        previous.cruise,
+                        previous.level,
+                    ) != (man.cruise, int(man.level)):
+                        delete_rows(
+                            cursor,
+                            previous.datatype,
+                            previous.freq,
+                            previous.cruise,
+                            previous.level,
+                        )
+                cursor.copy_expert(copy_query, stream, size=1 << 20)
+            conn.commit()
+            elapsed = time.perf_counter() - start
+
+            table = stats.setdefault(
+                table_name, {"files": 0, "rows": 0, "bytes": 0, "seconds": 0.0}
+            )
+            table["files"] += 1
+            table["rows"] += stream.rows
+            table["bytes"] += stream.bytes
+            table["seconds"] += elapsed
+            self.stdout.write(
+                f"Loaded {stream.rows} rows from {file} into {table_name}"
+            )
+            return man, stream, latest[0]
+        except Exception as e:
+            conn.rollback()
+            self.stdout.write(f"Error loading {file}: {e}")
+            with open(log_filename, "a") as log_file:
+                log_file.write(f"failed to ingest {file}\n")
+                log_file.write(f"Error: {e}\n\n")
+            return None
+
+    def report(self, stats):
+        self.stdout.write("table,files,rows,MB,seconds,rows/s,MB/s")
+        for table_name, table in sorted(stats.items()):
+            seconds = table["seconds"] or float("nan")
+            mb = table["bytes"] / 1e6
+            self.stdout.write(
+                f"{table_name},{table['files']},{table['rows']},{mb:.1f},"
+                f"{table['seconds']:.2f},{table['rows'] / seconds:.0f},"
+                f"{mb / seconds:.2f}"
+            )
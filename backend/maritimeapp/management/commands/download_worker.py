@@ -0,0 +1,77 @@
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from maritimeapp import jobs
+
+
+class Command(BaseCommand):
+    help = (
+        "Run queued download jobs. Keep at least one running alongside the "
+        "web server, or downloads handed to a job never start. Several "
+        "workers (threads or processes, on one or more hosts) can run side by "
+        "side."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--threads",
+            type=int,
+            default=2,
+            help="Jobs run at the same time by this process (default: 2).",
+        )
+        parser.add_argument(
+            "--poll",
+            type=float,
+            default=2.0,
+            help="Seconds to wait when the queue is empty (default: 2).",
+        )
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Exit once the queue is empty instead of polling.",
+        )
+
+    def handle(self, *args, **kwargs):
+        threads = [
+            threading.Thread(
+                target=self.work, args=(kwargs["poll"], kwargs["once"]), daemon=True
+            )
+            for _ in range(kwargs["threads"])
+        ]
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                thread.join()
+        except KeyboardInterrupt:
+            self.stdout.write(
+                "Stopping; other workers take over its running jobs once their "
+                "lease lapses."
+            )
+
+    def work(self, poll, once):
+        try:
+            while True:
+                expired = jobs.expire()
+                if expired:
+                    self.stdout.write(f"Expired {expired} download archives")
+
+                job = jobs.claim()
+                if job is None:
+                    if once:
+                        return
+                    time.sleep(poll)
+                    continue
+
+                start = time.perf_counter()
+                self.stdout.write(f"Running download job {job.pk}")
+                ok = jobs.run(job)
+                self.stdout.write(
+                    f"Download job {job.pk} {'done' if ok else 'failed'} in "
+                    f"{time.perf_counter() - start:.1f}s"
+                )
+        finally:
+            connection.close()
@@ -1,15 +1,13 @@
 import concurrent.futures
-import io
 import logging
 import os
-import tarfile
 
 import numpy as np
 import pandas as pd
-import requests
 from django.contrib.gis.geos import Point
 from django.core.management.base import BaseCommand
 from django.db.models import Max, Min
+from maritimeapp.ingest import MAN_ARCHIVE_URL, fetch_man_data
 from maritimeapp.models import *
 from rest_framework.exceptions import ValidationError
 
@@ -230,6 +228,13 @@ class Command(BaseCommand):
                 except Exception as exc:
                     print(f"Exception occurred: {exc}")
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--url",
+            default=MAN_ARCHIVE_URL,
+            help="Where to download the MAN archive from.",
+        )
+
     def handle(self, *args, **options):
         print("Attempting Session")
         file_endings = [
@@ -250,17 +255,16 @@ class Command(BaseCommand):
         ]
 
         # Download the MAN file from the static URL
-        url = "https://aeronet.gsfc.nasa.gov/new_web/All_MAN_Data_V3.tar.gz"
-        response = requests.get(url)
-
-        if not response.ok:
+        if (
+            fetch_man_data(
+                os.path.join(".", "src"),
+                options["url"],
+                policy_dest=os.path.join(".", "src"),
+            )
+            is None
+        ):
             print("Server Offline. Attempt again Later.")
             return
-
-        tar_contents = response.content
-
-        with tarfile.open(fileobj=io.BytesIO(tar_contents), mode="r:gz") as tar:
-            tar.extractall(path=r"./src")
         print("MAN Data Downloaded ...")
 
         # Read the folder contents
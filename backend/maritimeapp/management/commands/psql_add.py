@@ -1,10 +1,32 @@
 import csv
 import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
 
+import pandas as pd
 import psycopg2
 from django.conf import settings
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from psycopg2 import sql
+from psycopg2.pool import ThreadedConnectionPool
+
+from maritimeapp.cache import bump_ingest_generation
+from maritimeapp.export import (
+    build_fragments,
+    invalidate_fragments,
+    mark_fragments_ready,
+)
+from maritimeapp.ingest import BinaryCopyEncoder, FrameStream
+from maritimeapp.models import (
+    DownloadAODAP,
+    DownloadAODDaily,
+    DownloadAODSeries,
+    DownloadSDAAP,
+    DownloadSDADaily,
+    DownloadSDASeries,
+    Site,
+)
 
 DB_PARAMS = {
     "dbname": settings.DATABASES["default"]["NAME"],
@@ -15,13 +37,78 @@ DB_PARAMS = {
 }
 
 CSV_FOLDER = "./src_csvs/"
+CHUNK_ROWS = 100_000
+STAGING_SUFFIX = "__staging"
+OLD_SUFFIX = "__old"
+# The swap needs ACCESS EXCLUSIVE locks, which queue behind long readers (and
+# every later reader queues behind the swap). Give up after SWAP_LOCK_TIMEOUT
+# and try again, up to SWAP_ATTEMPTS times.
+SWAP_LOCK_TIMEOUT = "5s"
+SWAP_ATTEMPTS = 10
+
+# Every index on a table, with the constraint it backs (primary key/unique) if
+# any.
+INDEX_QUERY = """
+    SELECT i.relname, pg_get_indexdef(i.oid), c.conname, pg_get_constraintdef(c.oid)
+    FROM pg_index x
+    JOIN pg_class i ON i.oid = x.indexrelid
+    LEFT JOIN pg_constraint c
+        ON c.conindid = x.indexrelid AND c.conrelid = x.indrelid
+    WHERE x.indrelid = %s::regclass
+    ORDER BY i.relname
+"""
+
+MODELS = {
+    model._meta.db_table: model
+    for model in (
+        DownloadAODAP,
+        DownloadAODDaily,
+        DownloadAODSeries,
+        DownloadSDAAP,
+        DownloadSDADaily,
+        DownloadSDASeries,
+    )
+}
 
 
 class Command(BaseCommand):
     help = "Bulk import CSV files into PostgreSQL"
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--binary",
+            action="store_true",
+            help="Pre-encode rows and load them with binary COPY instead of CSV.",
+        )
+        parser.add_argument(
+            "--jobs",
+            type=int,
+            default=1,
+            help="Number of tables loaded concurrently, one connection each "
+            "(default: 1).",
+        )
+        parser.add_argument(
+            "--swap",
+            action="store_true",
+            help="Load into UNLOGGED staging tables, build their indexes, then "
+            "swap them with the live tables in a single transaction.",
+        )
+
     def handle(self, *args, **kwargs):
-        self.bulk_load_csvs_from_folder()
+        invalidate_fragments()
+        self.bulk_load_csvs_from_folder(
+            binary=kwargs["binary"], jobs=kwargs["jobs"], swap=kwargs["swap"]
+        )
+        # The new rows are live: retire cached archives and results now rather
+        # than once the fragments are rebuilt.
+        generation = bump_ingest_generation()
+        start = time.perf_counter()
+        fragments = build_fragments()
+        self.stdout.write(
+            f"Wrote {fragments} export fragments in "
+            f"{time.perf_counter() - start:.2f}s"
+        )
+        mark_fragments_ready(generation)
         # self.list_table_names()
 
     def get_db_connection(self):
@@ -32,38 +119,68 @@ class Command(BaseCommand):
             self.stdout.write(f"Error connecting to PostgreSQL: {e}")
             return None
 
-    def load_csv_to_postgres(self, csv_file, table_name):
+    def load_csv_to_postgres(
+        self, csv_file, table_name, conn=None, binary=False, into=None, strict=False
+    ):
+        # strict: re-raise load errors instead of logging and skipping the
+        # file, for --swap, where a partial table must never be swapped in.
         self.stdout.write(f"Loading {csv_file} into {table_name}...")
         with open(csv_file, "r", encoding="utf-8") as f:
             csv_reader = csv.reader(f)
             headers = next(csv_reader)
+
+        own_conn = conn is None
+        if own_conn:
             conn = self.get_db_connection()
-            if not conn:
-                self.stdout.write(
-                    f"Could not connect to the database. Skipping {csv_file}"
-                )
-                return
+        if not conn:
+            if strict:
+                raise CommandError(f"Could not connect to the database for {csv_file}")
+            self.stdout.write(f"Could not connect to the database. Skipping {csv_file}")
+            return 0
 
-            cursor = conn.cursor()
+        cursor = conn.cursor()
 
+        if binary:
+            insert_query = sql.SQL("COPY {} ({}) FROM STDIN WITH (FORMAT binary)")
+        else:
             insert_query = sql.SQL(
                 "COPY {} ({}) FROM STDIN WITH CSV HEADER DELIMITER ','"
-            ).format(
-                sql.Identifier(table_name),
-                sql.SQL(",").join(map(sql.Identifier, headers)),
             )
+        insert_query = insert_query.format(
+            sql.Identifier(into or table_name),
+            sql.SQL(",").join(map(sql.Identifier, headers)),
+        )
 
-            try:
+        rows = 0
+        try:
+            if binary:
+                frames = pd.read_csv(
+                    csv_file,
+                    dtype=str,
+                    keep_default_na=False,
+                    na_values=[""],
+                    chunksize=CHUNK_ROWS,
+                )
+                stream = FrameStream(
+                    frames, BinaryCopyEncoder(MODELS[table_name], headers)
+                )
+                cursor.copy_expert(insert_query, stream, size=1 << 20)
+            else:
                 with open(csv_file, "r", encoding="utf-8") as f:
                     cursor.copy_expert(insert_query, f)
-                conn.commit()
-                self.stdout.write(f"Successfully loaded {csv_file} into {table_name}")
-            except Exception as e:
-                self.stdout.write(f"Error loading {csv_file} into {table_name}: {e}")
-                conn.rollback()
-            finally:
-                cursor.close()
+            rows = cursor.rowcount
+            conn.commit()
+            self.stdout.write(f"Successfully loaded {csv_file} into {table_name}")
+        except Exception as e:
+            self.stdout.write(f"Error loading {csv_file} into {table_name}: {e}")
+            conn.rollback()
+            if strict:
+                raise
+        finally:
+            cursor.close()
+            if own_conn:
                 conn.close()
+        return rows
 
     def get_db_connection(self):
         try:
@@ -99,23 +216,255 @@ class Command(BaseCommand):
 
         return table_names
 
-    def bulk_load_csvs_from_folder(self):
-        for filename in os.listdir(CSV_FOLDER):
-            if filename.endswith(".csv"):
+    def table_for(self, filename):
+        table_name = filename.replace(".csv", "")
+        if "series_SDA" in filename:
+            table_name = "maritimeapp_downloadsdaseries"
+        if "all_points_SDA" in filename:
+            table_name = "maritimeapp_downloadsdaap"
+        if "daily_SDA" in filename:
+            table_name = "maritimeapp_downloadsdadaily"
+        if "series_AOD" in filename:
+            table_name = "maritimeapp_downloadaodseries"
+        if "all_points_AOD" in filename:
+            table_name = "maritimeapp_downloadaodap"
+        if "daily_AOD" in filename:
+            table_name = "maritimeapp_downloadaoddaily"
+        return table_name
+
+    def load_table(self, pool, table_name, csv_files, binary, swap=False):
+        conn = pool.getconn() if pool else self.get_db_connection()
+        into = table_name + STAGING_SUFFIX if swap else table_name
+        rows = 0
+        renames = []
+        start = time.perf_counter()
+        try:
+            for csv_file in csv_files:
+                rows += max(
+                    self.load_csv_to_postgres(
+                        csv_file, table_name, conn, binary, into=into, strict=swap
+                    ),
+                    0,
+                )
+            if swap:
+                renames = self.finalize_staging_table(conn, table_name)
+        finally:
+            if pool:
+                pool.putconn(conn)
+            elif conn:
+                conn.close()
+        return table_name, len(csv_files), rows, time.perf_counter() - start, renames
+
+    def create_staging_tables(self, table_names):
+        # Staging copies carry columns, defaults, identity and checks but no
+        # indexes; those are built once the data is in.
+        conn = self.get_db_connection()
+        with conn, conn.cursor() as cursor:
+            for table_name in table_names:
+                staging = table_name + STAGING_SUFFIX
+                cursor.execute(
+                    sql.SQL("DROP TABLE IF EXISTS {}").format(sql.Identifier(staging))
+                )
+                cursor.execute(
+                    sql.SQL(
+                        "CREATE UNLOGGED TABLE {} "
+                        "(LIKE {} INCLUDING ALL EXCLUDING INDEXES)"
+                    ).format(sql.Identifier(staging), sql.Identifier(table_name))
+                )
+        conn.close()
+
+    def drop_staging_tables(self, table_names):
+        conn = self.get_db_connection()
+        if not conn:
+            return
+        with conn, conn.cursor() as cursor:
+            for table_name in table_names:
+                cursor.execute(
+                    sql.SQL("DROP TABLE IF EXISTS {}").format(
+                        sql.Identifier(table_name + STAGING_SUFFIX)
+                    )
+                )
+        conn.close()
+
+    def finalize_staging_table(self, conn, table_name):
+        # Make the staging table durable and rebuild the live table's indexes
+        # on it under temporary names. Returns the renames to apply after the
+        # swap so the new generation ends up with the original names.
+        staging = table_name + STAGING_SUFFIX
+        renames = []
+        with conn.cursor() as cursor:
+            cursor.execute(
+                sql.SQL("ALTER TABLE {} SET LOGGED").format(sql.Identifier(staging))
+            )
+            cursor.execute(INDEX_QUERY, [table_name])
+            for n, (index_name, index_def, con_name, con_def) in enumerate(
+                cursor.fetchall()
+            ):
+                temp_name = f"{staging}_{n}"
+                if con_name:
+                    cursor.execute(
+                        sql.SQL("ALTER TABLE {} ADD CONSTRAINT {} ").format(
+                            sql.Identifier(staging), sql.Identifier(temp_name)
+                        )
+                        + sql.SQL(con_def)
+                    )
+                    renames.append(("constraint", temp_name, con_name))
+                else:
+                    match = re.match(
+                        r"CREATE (UNIQUE )?INDEX \S+ ON \S+ (.*)", index_def
+                    )
+                    cursor.execute(
+                        sql.SQL("CREATE {}INDEX {} ON {} ").format(
+                            sql.SQL(match.group(1) or ""),
+                            sql.Identifier(temp_name),
+                            sql.Identifier(staging),
+                        )
+                        + sql.SQL(match.group(2))
+                    )
+                    renames.append(("index", temp_name, index_name))
+            cursor.execute(sql.SQL("ANALYZE {}").format(sql.Identifier(staging)))
+        conn.commit()
+        return renames
+
+    def update_staging_span_dates(self):
+        conn = self.get_db_connection()
+        with conn, conn.cursor() as cursor:
+            cursor.execute(
+                sql.SQL(
+                    "UPDATE {} s SET span_date = ARRAY[d.start_date, d.end_date] "
+                    "FROM (SELECT cruise, MIN({date}) AS start_date, "
+                    "MAX({date}) AS end_date FROM {} WHERE level = 15 "
+                    "GROUP BY cruise) d WHERE d.cruise = s.name"
+                ).format(
+                    sql.Identifier(Site._meta.db_table + STAGING_SUFFIX),
+                    sql.Identifier(DownloadAODDaily._meta.db_table + STAGING_SUFFIX),
+                    date=sql.Identifier("date_DD_MM_YYYY"),
+                )
+            )
+        conn.close()
+
+    def swap_staging_tables(self, results):
+        conn = self.get_db_connection()
+        try:
+            for attempt in range(1, SWAP_ATTEMPTS + 1):
+                try:
+                    self.swap_tables(conn, results)
+                    break
+                except psycopg2.errors.LockNotAvailable:
+                    if attempt == SWAP_ATTEMPTS:
+                        raise
+                    self.stdout.write(
+                        f"Swap timed out waiting for locks, retrying "
+                        f"({attempt}/{SWAP_ATTEMPTS})"
+                    )
+                    time.sleep(attempt)
+        finally:
+            conn.close()
+        self.stdout.write(f"Swapped in {len(results)} staging tables")
+
+    def swap_tables(self, conn, results):
+        # One transaction: readers see the old generation until COMMIT, and a
+        # failed attempt rolls back to it.
+        with conn, conn.cursor() as cursor:
+            cursor.execute(
+                sql.SQL("SET LOCAL lock_timeout = {}").format(
+                    sql.Literal(SWAP_LOCK_TIMEOUT)
+                )
+            )
+            for table_name, *_ in results:
+                cursor.execute(
+                    sql.SQL("ALTER TABLE {} RENAME TO {}").format(
+                        sql.Identifier(table_name),
+                        sql.Identifier(table_name + OLD_SUFFIX),
+                    )
+                )
+                cursor.execute(
+                    sql.SQL("ALTER TABLE {} RENAME TO {}").format(
+                        sql.Identifier(table_name + STAGING_SUFFIX),
+                        sql.Identifier(table_name),
+                    )
+                )
+            for table_name, *_ in results:
+                cursor.execute(
+                    sql.SQL("DROP TABLE {}").format(
+                        sql.Identifier(table_name + OLD_SUFFIX)
+                    )
+                )
+            for table_name, *_, renames in results:
+                for kind, temp_name, name in renames:
+                    if kind == "constraint":
+                        query = sql.SQL("ALTER TABLE {} RENAME CONSTRAINT {} TO {}")
+                        query = query.format(
+                            sql.Identifier(table_name),
+                            sql.Identifier(temp_name),
+                            sql.Identifier(name),
+                        )
+                    else:
+                        query = sql.SQL("ALTER INDEX {} RENAME TO {}").format(
+                            sql.Identifier(temp_name), sql.Identifier(name)
+                        )
+                    cursor.execute(query)
+
+    def load_tables(self, tables, binary, jobs, swap):
+        # Only the measurement tables can be pre-encoded; anything else keeps
+        # using CSV COPY.
+        binary_tables = MODELS if binary else {}
+
+        if jobs > 1:
+            pool = ThreadedConnectionPool(1, jobs, **DB_PARAMS)
+            try:
+                with ThreadPoolExecutor(max_workers=jobs) as executor:
+                    futures = [
+                        executor.submit(
+                            self.load_table,
+                            pool,
+                            table_name,
+                            csv_files,
+                            table_name in binary_tables,
+                            swap,
+                        )
+                        for table_name, csv_files in tables.items()
+                    ]
+                    return [future.result() for future in futures]
+            finally:
+                pool.closeall()
+        return [
+            self.load_table(
+                None, table_name, csv_files, table_name in binary_tables, swap
+            )
+            for table_name, csv_files in tables.items()
+        ]
+
+    def bulk_load_csvs_from_folder(self, binary=False, jobs=1, swap=False):
+        tables = {}
+        for filename in sorted(os.listdir(CSV_FOLDER)):
+            if filename.endswith(".csv") and filename != "sites.csv":
                 csv_file = os.path.join(CSV_FOLDER, filename)
-                table_name = filename.replace(".csv", "")
-                if "series_SDA" in filename:
-                    table_name = "maritimeapp_downloadsdaseries"
-                if "all_points_SDA" in filename:
-                    table_name = "maritimeapp_downloadsdaap"
-                if "daily_SDA" in filename:
-                    table_name = "maritimeapp_downloadsdadaily"
-                if "series_AOD" in filename:
-                    table_name = "maritimeapp_downloadaodseries"
-                if "all_points_AOD" in filename:
-                    table_name = "maritimeapp_downloadaodap"
-                if "daily_AOD" in filename:
-                    table_name = "maritimeapp_downloadaoddaily"
-
-                self.load_csv_to_postgres(csv_file, table_name)
-        self.load_csv_to_postgres("./src_csvs/sites.csv", "maritimeapp_site")
+                tables.setdefault(self.table_for(filename), []).append(csv_file)
+        site_files = {Site._meta.db_table: ["./src_csvs/sites.csv"]}
+
+        if swap:
+            self.create_staging_tables(list(tables) + list(site_files))
+
+        try:
+            start = time.perf_counter()
+            results = self.load_tables(tables, binary, jobs, swap)
+            elapsed = time.perf_counter() - start
+
+            site_results = self.load_tables(site_files, False, 1, swap)
+            if swap:
+                self.update_staging_span_dates()
+                self.swap_staging_tables(results + site_results)
+        except Exception as e:
+            if not swap:
+                raise
+            # The live tables are untouched; throw the staging copies away.
+            self.drop_staging_tables(list(tables) + list(site_files))
+            raise CommandError(f"Reload aborted, live tables kept: {e}") from e
+
+        self.stdout.write("table,files,rows,seconds,rows/s")
+        for table_name, files, rows, seconds, _ in sorted(results):
+            rate = rows / seconds if seconds else 0
+            self.stdout.write(f"{table_name},{files},{rows},{seconds:.2f},{rate:.0f}")
+        total = sum(result[2] for result in results)
+        self.stdout.write(f"total,,{total},{elapsed:.2f},{total / elapsed:.0f}")
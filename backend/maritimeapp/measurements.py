@@ -0,0 +1,248 @@
+"""
+Compact encodings of site_measurements responses. The rows are read from
+COPY straight into Arrow arrays and encoded column by column, so no Python
+object is built per measurement.
+"""
+
+import io
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+from django.db import connection
+from django.db.models import BigIntegerField, FloatField, Func
+
+from .models import DownloadAODDaily
+
+ARROW_CONTENT_TYPE = "application/vnd.apache.arrow.stream"
+
+# Response formats of site_measurements; "rows" is the original list of dicts.
+MEASUREMENT_FORMATS = ("rows", "columnar", "arrow")
+
+
+def measurement_readings(data):
+    """
+    The readings a site_measurements request asks for, in order: "readings"
+    (a list) or the single "reading".
+    """
+    readings = data.get("readings") or [data.get("reading")]
+    if isinstance(readings, str):
+        readings = [readings]
+    choices = {
+        field.name
+        for field in DownloadAODDaily._meta.fields
+        if isinstance(field, FloatField)
+    }
+    unknown = [reading for reading in readings if reading not in choices]
+    if unknown:
+        raise ValueError(f"Unknown readings: {', '.join(map(str, unknown))}")
+    return list(dict.fromkeys(readings))
+
+
+class Epoch(Func):
+    # Seconds since 1970 of a date column plus a time column, taken as UTC.
+    template = "EXTRACT(EPOCH FROM (%(expressions)s))::bigint"
+    arg_joiner = " + "
+    output_field = BigIntegerField()
+
+
+class STX(Func):
+    function = "ST_X"
+    output_field = FloatField()
+
+
+class STY(Func):
+    function = "ST_Y"
+    output_field = FloatField()
+
+
+def measurement_table(queryset, readings):
+    """
+    Arrow table with cruise, aeronet_number, time (epoch seconds), lng, lat
+    and one float column per reading.
+    """
+    query = queryset.values(
+        "cruise",
+        "aeronet_number",
+        *readings,
+        time=Epoch("date_DD_MM_YYYY", "time_HH_MM_SS"),
+        lng=STX("coordinates"),
+        lat=STY("coordinates"),
+    )
+    buffer = io.BytesIO()
+    with connection.cursor() as cursor:
+        sql, params = query.query.sql_with_params()
+        cursor.cursor.copy_expert(
+            "COPY ({}) TO STDOUT WITH CSV HEADER".format(
+                cursor.cursor.mogrify(sql, params).decode("utf-8")
+            ),
+            buffer,
+        )
+    column_types = {
+        "cruise": pa.string(),
+        "aeronet_number": pa.int32(),
+        "time": pa.int64(),
+        "lng": pa.float64(),
+        "lat": pa.float64(),
+        **{reading: pa.float64() for reading in readings},
+    }
+    return pacsv.read_csv(
+        pa.BufferReader(buffer.getvalue()),
+        convert_options=pacsv.ConvertOptions(
+            column_types=column_types, null_values=["", "NaN"]
+        ),
+    )
+
+
+def lttb_indices(x, y, n_out):
+    """
+    Indexes of about n_out points of the series (x, y), x sorted, picked by
+    Largest-Triangle-Three-Buckets. The previous bucket's average stands in
+    for its selected point, so every bucket is computed at once. Points with
+    a missing (NaN) y are never picked unless the series fits in n_out.
+    """
+    n = len(x)
+    if n <= n_out or n <= 2:
+        return np.arange(n)
+    missing = np.isnan(y)
+    if missing.any():
+        present = np.flatnonzero(~missing)
+        return present[lttb_indices(x[present], y[present], n_out)]
+    if n_out < 3:
+        return np.array([0, n - 1])
+    buckets = n_out - 2
+    # Inner points 1..n-2 split into buckets of (nearly) equal size.
+    edges = np.linspace(1, n - 1, buckets + 1).astype(np.int64)
+    bucket = np.searchsorted(edges, np.arange(1, n - 1), side="right") - 1
+    counts = np.bincount(bucket, minlength=buckets)
+    px, py = x[1:-1], y[1:-1]
+    mean_x = np.bincount(bucket, px, buckets) / counts
+    mean_y = np.bincount(bucket, py, buckets) / counts
+    ax = np.concatenate([[x[0]], mean_x[:-1]])[bucket]
+    ay = np.concatenate([[y[0]], mean_y[:-1]])[bucket]
+    cx = np.concatenate([mean_x[1:], [x[-1]]])[bucket]
+    cy = np.concatenate([mean_y[1:], [y[-1]]])[bucket]
+    area = np.abs((ax - cx) * (py - ay) - (ax - px) * (cy - ay))
+    # The largest triangle of each bucket comes first in this order.
+    order = np.lexsort((-area, bucket))
+    first = np.concatenate([[True], bucket[order][1:] != bucket[order][:-1]])
+    return np.concatenate([[0], np.sort(order[first]) + 1, [n - 1]])
+
+
+def point_budgets(sizes, max_points):
+    # Split max_points between series of the given sizes in proportion to
+    # them, by largest remainder, so the budgets add up to max_points.
+    share = max_points * sizes / sizes.sum()
+    budgets = np.floor(share).astype(np.int64)
+    extra = max_points - budgets.sum()
+    budgets[np.argsort(budgets - share, kind="stable")[:extra]] += 1
+    return budgets
+
+
+def decimate(table, reading, max_points):
+    """
+    Thin table to at most max_points rows, shared between cruises by their
+    size, keeping the shape of each cruise's reading over time. Cruises too
+    small to get a point when there are more cruises than points are left
+    out. Rows are picked on reading alone: any other readings are the
+    values at those same rows. Returns the rows in cruise and time order.
+    """
+    if table.num_rows <= max_points:
+        return table
+    table = table.take(
+        pc.sort_indices(table, [("cruise", "ascending"), ("time", "ascending")])
+    )
+    cruise = encoded_sites(table).indices.to_numpy()
+    time = table["time"].to_numpy().astype(np.float64)
+    value = table[reading].to_numpy(zero_copy_only=False).astype(np.float64)
+    starts = np.flatnonzero(np.concatenate([[True], cruise[1:] != cruise[:-1]]))
+    ends = np.append(starts[1:], len(cruise))
+    keep = []
+    for start, end, budget in zip(
+        starts, ends, point_budgets(ends - starts, max_points)
+    ):
+        if budget < 3:
+            # lttb_indices keeps both ends of a series whatever its budget.
+            keep.append(np.array([start, end - 1][:budget], dtype=np.int64))
+        else:
+            keep.append(start + lttb_indices(time[start:end], value[start:end], budget))
+    return table.take(np.concatenate(keep)) if keep else table
+
+
+def table_rows(table, readings):
+    """
+    The original site_measurements rows, built from a (small) table. "value"
+    is the first reading; with several, "values" holds them all.
+    """
+    stamps = np.datetime_as_string(table["time"].to_numpy().astype("datetime64[s]"))
+    rows = [
+        {
+            "aeronet_number": number,
+            "site": site,
+            "date": stamp[:10],
+            "time": stamp[11:],
+            "value": value,
+            "coordinates": None if lng is None else {"lng": lng, "lat": lat},
+        }
+        for number, site, stamp, value, lng, lat in zip(
+            table["aeronet_number"].to_pylist(),
+            table["cruise"].to_pylist(),
+            stamps,
+            table[readings[0]].to_pylist(),
+            table["lng"].to_pylist(),
+            table["lat"].to_pylist(),
+        )
+    ]
+    if len(readings) > 1:
+        columns = [table[reading].to_pylist() for reading in readings]
+        for row, values in zip(rows, zip(*columns)):
+            row["values"] = dict(zip(readings, values))
+    return rows
+
+
+def encoded_sites(table):
+    return pc.dictionary_encode(table["cruise"]).combine_chunks()
+
+
+def columnar_json(table, readings, decimated=False, total=None):
+    """
+    Parallel arrays, one per field. Sites are dictionary-encoded: "site"
+    holds indexes into "sites". total is the row count before decimation.
+    """
+    sites = encoded_sites(table)
+    return {
+        "format": "columnar",
+        "count": table.num_rows,
+        "decimated": decimated,
+        "total": table.num_rows if total is None else total,
+        "sites": sites.dictionary.to_pylist(),
+        "site": sites.indices.to_pylist(),
+        "time": table["time"].to_pylist(),
+        "lng": table["lng"].to_pylist(),
+        "lat": table["lat"].to_pylist(),
+        "aeronet_number": table["aeronet_number"].to_pylist(),
+        "values": {reading: table[reading].to_pylist() for reading in readings},
+    }
+
+
+def arrow_body(table, readings, decimated=False):
+    """
+    The same columns as columnar_json, as an Arrow IPC stream; decimated is
+    kept in the schema metadata.
+    """
+    table = pa.table(
+        {
+            "site": encoded_sites(table),
+            "time": table["time"],
+            "lng": table["lng"],
+            "lat": table["lat"],
+            "aeronet_number": table["aeronet_number"],
+            **{reading: table[reading] for reading in readings},
+        },
+        metadata={"decimated": str(decimated).lower()},
+    )
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
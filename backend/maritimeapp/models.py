@@ -1,8 +1,9 @@
+import uuid
+
 from django.contrib.gis.db import models as gis_models
 from django.contrib.gis.geos import Point
 from django.contrib.postgres.fields import ArrayField
-from django.db import models
-from django.db.models import Max, Min
+from django.db import connection, models
 
 
 class Site(models.Model):
@@ -18,16 +19,48 @@ class Site(models.Model):
     )
 
     def update_span_date(self):
-        dates = DownloadAODDaily.objects.filter(cruise=self.name, level=15).aggregate(
-            start_date=Min("date_DD_MM_YYYY"), end_date=Max("date_DD_MM_YYYY")
-        )
-        Site.objects.filter(pk=self.pk).update(
-            span_date=[dates["start_date"], dates["end_date"]]
+        Site.update_span_dates([self.name])
+
+    @classmethod
+    def update_span_dates(cls, names=None):
+        """
+        Recompute span_date from the level 15 daily AOD rows in one grouped
+        UPDATE, for every site or only those in names. Sites without daily
+        rows get [NULL, NULL]. Cached list_sites results are dropped.
+        """
+        # export imports the models.
+        from .export import bump_generation_keeping_fragments
+
+        query = (
+            "UPDATE {site} s SET span_date = ARRAY[d.start_date, d.end_date] "
+            "FROM (SELECT s2.name, MIN(a.{date}) AS start_date, "
+            "MAX(a.{date}) AS end_date FROM {site} s2 "
+            "LEFT JOIN {daily} a ON a.cruise = s2.name AND a.level = 15 "
+            "{where}GROUP BY s2.name) d WHERE d.name = s.name"
         )
+        params = []
+        where = ""
+        if names is not None:
+            where = "WHERE s2.name = ANY(%s) "
+            params.append(list(names))
+        with connection.cursor() as cursor:
+            cursor.execute(
+                query.format(
+                    site=connection.ops.quote_name(cls._meta.db_table),
+                    daily=connection.ops.quote_name(DownloadAODDaily._meta.db_table),
+                    date=connection.ops.quote_name("date_DD_MM_YYYY"),
+                    where=where,
+                ),
+                params,
+            )
+            updated = cursor.rowcount
+        bump_generation_keeping_fragments()
+        return updated
 
-    def save(self, *args, **kwargs):
+    def save(self, *args, update_span=True, **kwargs):
         super().save(*args, **kwargs)
-        self.update_span_date()
+        if update_span:
+            self.update_span_date()
 
 
 """
@@ -559,3 +592,43 @@ class TableHeader(models.Model):
                 fields=["datatype", "level", "freq"], name="unique_dataType_level"
             )
         ]
+
+
+class IngestLedger(models.Model):
+    # One row per MAN source file, written by direct_ingest. Lets an
+    # incremental run skip files whose size and hash have not changed.
+    source_file = models.CharField(primary_key=True, max_length=255)
+    cruise = models.CharField(max_length=255)
+    datatype = models.CharField(max_length=255)
+    freq = models.CharField(max_length=255)
+    level = models.IntegerField()
+    size = models.BigIntegerField()
+    sha256 = models.CharField(max_length=64)
+    last_processing_date = models.DateField(null=True, blank=True)
+    rows = models.IntegerField(default=0)
+    ingested_at = models.DateTimeField(auto_now=True)
+
+
+class DownloadJob(models.Model):
+    # A download_data request run in the background by the download_worker
+    # command. params is the normalized request (export.download_params).
+    # started_at is renewed by the worker while the job runs (see jobs.py).
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    EXPIRED = "expired"
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    params = models.JSONField()
+    status = models.CharField(max_length=16, default=QUEUED, db_index=True)
+    files_total = models.IntegerField(default=0)
+    files_done = models.IntegerField(default=0)
+    rows_written = models.BigIntegerField(default=0)
+    path = models.CharField(max_length=1024, blank=True, default="")
+    filename = models.CharField(max_length=255, blank=True, default="")
+    error = models.TextField(blank=True, default="")
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    expires_at = models.DateTimeField(null=True, blank=True)
@@ -0,0 +1,201 @@
+"""
+Cache of the map's query responses (list_sites and site_measurements).
+
+Bodies are kept gzip-compressed, so a hit is sent as stored. Entries live in
+an in-process LRU bounded by RESULT_CACHE_BYTES and, when configured, in the
+shared "results" Django cache, so every worker sees what one has computed.
+Keys include the ingest generation (see cache.py): an ingest makes every
+older entry unreachable.
+"""
+
+import gzip
+import json
+import threading
+from collections import Counter, OrderedDict
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse
+from django.utils.timezone import now
+
+from .cache import ingest_generation, request_key
+from .measurements import measurement_readings
+
+# Bounding boxes are keyed to about 10 cm; the map never pans finer.
+BBOX_DIGITS = 6
+BBOX_PARAMS = ("min_lat", "min_lng", "max_lat", "max_lng")
+# Response headers kept along with the body.
+CACHED_HEADERS = ("X-Decimated", "X-Total-Points")
+
+# Per process; served by results_cache_stats.
+stats = Counter()
+
+entries = OrderedDict()
+entries_lock = threading.Lock()
+entries_state = {"bytes": 0, "generation": None}
+
+
+def shared_cache():
+    return caches["results"] if "results" in settings.CACHES else None
+
+
+def bbox_params(data):
+    return [
+        round(float(data[name]), BBOX_DIGITS) if data.get(name) else None
+        for name in BBOX_PARAMS
+    ]
+
+
+def sites_params(request):
+    data = request.GET
+    params = {
+        "bbox": bbox_params(data),
+        "start_date": data.get("start_date") or None,
+        "end_date": data.get("end_date") or None,
+    }
+    if params["start_date"] and not params["end_date"]:
+        # list_sites then filters up to today.
+        params["today"] = now().date().isoformat()
+    return params
+
+
+def measurement_params(request):
+    data = json.loads(request.body)
+    sites = data.get("sites") or []
+    if not isinstance(sites, list):
+        return None
+    return {
+        "sites": sorted(set(map(str, sites))),
+        "bbox": bbox_params(data),
+        "start_date": data.get("start_date") or None,
+        "end_date": data.get("end_date") or None,
+        "readings": measurement_readings(data),
+        "format": data.get("format") or "rows",
+        "max_points": int(data.get("max_points") or 0),
+    }
+
+
+def remember(key, entry):
+    size = len(key) + len(entry[0])
+    if size > settings.RESULT_CACHE_BYTES // 8:
+        return
+    with entries_lock:
+        if key in entries:
+            return
+        entries[key] = entry
+        entries_state["bytes"] += size
+        while entries_state["bytes"] > settings.RESULT_CACHE_BYTES:
+            old_key, old = entries.popitem(last=False)
+            entries_state["bytes"] -= len(old_key) + len(old[0])
+            stats["evictions"] += 1
+
+
+def lookup(key, generation):
+    """
+    (gzip body, content type, headers) stored under key, or None. A shared
+    hit is copied into this process.
+    """
+    with entries_lock:
+        if entries_state["generation"] != generation:
+            # New data has landed: nothing held here can be served again.
+            if entries:
+                stats["invalidations"] += 1
+            entries.clear()
+            entries_state["bytes"] = 0
+            entries_state["generation"] = generation
+        entry = entries.get(key)
+        if entry is not None:
+            entries.move_to_end(key)
+            stats["hits"] += 1
+            return entry
+    shared = shared_cache()
+    entry = shared.get(key) if shared is not None else None
+    if entry is None:
+        stats["misses"] += 1
+        return None
+    stats["hits"] += 1
+    stats["shared_hits"] += 1
+    remember(key, entry)
+    return entry
+
+
+def store(key, response):
+    entry = (
+        gzip.compress(response.content, compresslevel=6),
+        response["Content-Type"],
+        {name: response[name] for name in CACHED_HEADERS if response.has_header(name)},
+    )
+    remember(key, entry)
+    shared = shared_cache()
+    if shared is not None:
+        shared.set(key, entry)
+    stats["stores"] += 1
+    return entry
+
+
+def entry_response(request, entry):
+    body, content_type, headers = entry
+    if "gzip" in request.META.get("HTTP_ACCEPT_ENCODING", ""):
+        response = HttpResponse(body, content_type=content_type)
+        response["Content-Encoding"] = "gzip"
+    else:
+        response = HttpResponse(gzip.decompress(body), content_type=content_type)
+    response["Vary"] = "Accept-Encoding"
+    for name, value in headers.items():
+        response[name] = value
+    return response
+
+
+def cached_result(normalize):
+    """
+    Serve a view from the result cache. normalize(request) returns the
+    canonical parameters the response depends on; requests it cannot read
+    (None or ValueError) go straight to the view, which reports the error.
+    Only complete 200 responses are stored.
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            try:
+                params = normalize(request)
+            except (TypeError, ValueError):
+                params = None
+            if params is None:
+                stats["uncacheable"] += 1
+                return view(request, *args, **kwargs)
+
+            generation = ingest_generation()
+            key = request_key(
+                {"view": view.__name__, "generation": generation, **params}
+            )
+            entry = lookup(key, generation)
+            status = "HIT"
+            if entry is None:
+                response = view(request, *args, **kwargs)
+                if response.status_code != 200 or response.streaming:
+                    return response
+                entry = store(key, response)
+                status = "MISS"
+            response = entry_response(request, entry)
+            response["X-Cache"] = status
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+def results_stats():
+    lookups = stats["hits"] + stats["misses"]
+    with entries_lock:
+        held = {"entries": len(entries), "bytes": entries_state["bytes"]}
+    return {
+        **stats,
+        **held,
+        "hit_rate": stats["hits"] / lookups if lookups else None,
+        "budget": settings.RESULT_CACHE_BYTES,
+        "shared": shared_cache() is not None,
+        "generation": ingest_generation(),
+    }
@@ -1,3 +1,561 @@
-from django.test import TestCase
+import io
+import os
+import re
+import struct
+import tarfile
+import tempfile
+import threading
+from datetime import date
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+import pandas as pd
+import psycopg2
+import pyarrow as pa
+import pyarrow.compute as pc
+import requests
+from django.test import RequestFactory, SimpleTestCase
+from psycopg2 import sql
+
+from .ingest import (
+    EWKB_POINT,
+    PG_EPOCH,
+    PGCOPY_HEADER,
+    PGCOPY_TRAILER,
+    BinaryCopyEncoder,
+    FrameStream,
+    download_archive,
+    encode_date,
+    encode_float8,
+    encode_geometry,
+    encode_int4,
+    encode_text,
+    encode_time,
+    extract_man_files,
+    parse_date_column,
+    parse_dates,
+    parse_points,
+    points_to_ewkb_hex,
+    points_to_wkt,
+    prepare_frame,
+)
+from .management.commands import psql_add
+from .measurements import decimate, lttb_indices
+from .models import DownloadAODDaily
+from .results import sites_params
+
+
+def field_values(fields, fmt):
+    # Undo one column of length-prefixed binary COPY fields.
+    values = []
+    for field in fields:
+        (length,) = struct.unpack(">i", field[:4])
+        if length == -1:
+            values.append(None)
+        elif fmt is None:
+            values.append(field[4 : 4 + length].decode("utf-8"))
+        else:
+            values.append(struct.unpack(fmt, field[4 : 4 + length])[0])
+    return values
+
+
+def copy_rows(data, formats):
+    """Rows of a whole binary COPY stream, one struct format per column."""
+    assert data.startswith(PGCOPY_HEADER) and data.endswith(PGCOPY_TRAILER)
+    body = data[len(PGCOPY_HEADER) : -len(PGCOPY_TRAILER)]
+    rows = []
+    pos = 0
+    while pos < len(body):
+        (count,) = struct.unpack(">h", body[pos : pos + 2])
+        pos += 2
+        row = []
+        for fmt in formats[:count]:
+            (length,) = struct.unpack(">i", body[pos : pos + 4])
+            field = body[pos : pos + 4 + max(length, 0)]
+            pos += len(field)
+            row.append(field_values([field], fmt)[0])
+        rows.append(row)
+    return rows
+
+
+class BinaryCopyTests(SimpleTestCase):
+    def test_float8(self):
+        fields = encode_float8(pd.Series(["1.5", "", None, "-2e-3", "x"]))
+        self.assertEqual(field_values(fields, ">d"), [1.5, None, None, -0.002, None])
+
+    def test_int4(self):
+        fields = encode_int4(pd.Series(["7", None, "-3", "2147483647"]))
+        self.assertEqual(field_values(fields, ">i"), [7, None, -3, 2147483647])
+
+    def test_date(self):
+        fields = encode_date(pd.Series(["2000-01-01", "1999-12-31", None, "bad"]))
+        self.assertEqual(field_values(fields, ">i"), [0, -1, None, None])
+        days = field_values(encode_date(pd.Series(["2024-02-29"])), ">i")[0]
+        self.assertEqual(
+            (PG_EPOCH + np.timedelta64(days, "D")).item(), date(2024, 2, 29)
+        )
+
+    def test_time(self):
+        fields = encode_time(pd.Series(["00:00:00", "12:34:56", None]))
+        self.assertEqual(
+            field_values(fields, ">q"), [0, (12 * 3600 + 34 * 60 + 56) * 10**6, None]
+        )
+
+    def test_text(self):
+        fields = encode_text(pd.Series(["Cruise_1", "Été", None]))
+        self.assertEqual(field_values(fields, None), ["Cruise_1", "Été", None])
+
+    def test_geometry(self):
+        fields = encode_geometry(pd.Series(["POINT (1.5 -2.25)", "POINT (0 90)"]))
+        for field, (x, y) in zip(fields, [(1.5, -2.25), (0.0, 90.0)]):
+            self.assertEqual(struct.unpack(">i", field[:4])[0], EWKB_POINT.itemsize)
+            point = np.frombuffer(field[4:], dtype=EWKB_POINT)[0]
+            self.assertEqual((point["srid"], point["x"], point["y"]), (4326, x, y))
+
+    def test_encoder_stream(self):
+        columns = ["date_DD_MM_YYYY", "time_HH_MM_SS", "aod_500nm", "level", "cruise"]
+        frames = [
+            pd.DataFrame(
+                [["2010-02-01", "10:00:00", "0.25", "15", "Cruise_1"]], columns=columns
+            ),
+            pd.DataFrame([["2010-02-02", None, "", "20", None]], columns=columns),
+        ]
+        stream = FrameStream(frames, BinaryCopyEncoder(DownloadAODDaily, columns))
+        data = b"".join(iter(lambda: stream.read(7), b""))
+        self.assertEqual(stream.rows, 2)
+        self.assertEqual(
+            copy_rows(data, [">i", ">q", ">d", ">i", None]),
+            [
+                [3684, 36000 * 10**6, 0.25, 15, "Cruise_1"],
+                [3685, None, None, 20, None],
+            ],
+        )
+
+
+class DateParsingTests(SimpleTestCase):
+    def test_parse_dates(self):
+        source = ["29:02:2020", "31:02:2020", "1:2:2020", "01:12:1999", None, "x"]
+        batch = pa.RecordBatch.from_arrays(
+            [pa.array(source), pa.array(source)],
+            names=["date_DD_MM_YYYY", "cruise"],
+        )
+        parsed = parse_dates(batch)
+        self.assertEqual(
+            parsed["date_DD_MM_YYYY"].to_pylist(),
+            [date(2020, 2, 29), None, date(2020, 2, 1), date(1999, 12, 1), None, None],
+        )
+        self.assertEqual(parsed["cruise"].to_pylist(), source)
+
+    def test_padded_dates_only(self):
+        column = parse_date_column(pa.array(["01:01:2010", "28:02:2011"]))
+        self.assertEqual(column.to_pylist(), [date(2010, 1, 1), date(2011, 2, 28)])
+
+
+class CoordinateTests(SimpleTestCase):
+    def test_ewkb_hex(self):
+        hexed = points_to_ewkb_hex([1.0, -73.5], [2.0, 40.25])
+        # Little endian, Point with the SRID flag, SRID 4326, x, y.
+        self.assertEqual(
+            hexed[0],
+            "01"
+            + "01000020"
+            + "E6100000"
+            + struct.pack("<d", 1.0).hex().upper()
+            + struct.pack("<d", 2.0).hex().upper(),
+        )
+        lng, lat = parse_points(pd.Series(hexed))
+        self.assertEqual(list(lng), [1.0, -73.5])
+        self.assertEqual(list(lat), [2.0, 40.25])
+
+    def test_wkt(self):
+        wkt = points_to_wkt([1.0, 1e-05, -12.5, 0.1 + 0.2], [2.0, -3e-07, 0.0, 5.0])
+        self.assertEqual(
+            list(wkt),
+            [
+                "POINT (1 2)",
+                "POINT (0.00001 -0.0000003)",
+                "POINT (-12.5 0)",
+                "POINT (0.30000000000000004 5)",
+            ],
+        )
+        lng, lat = parse_points(pd.Series(wkt))
+        self.assertEqual(list(lng), [1.0, 1e-05, -12.5, 0.1 + 0.2])
+        self.assertEqual(list(lat), [2.0, -3e-07, 0.0, 5.0])
+
+    def test_ewkt(self):
+        lng, lat = parse_points(pd.Series(["SRID=4326;POINT (3 4)"]))
+        self.assertEqual((lng[0], lat[0]), (3.0, 4.0))
+
+    def test_prepare_frame_wkt(self):
+        man = SimpleNamespace(cruise="Cruise_1", level="15", pi="", pi_email="")
+        for coordinates in ["ewkb", "ewkt"]:
+            frame = pd.DataFrame({"Longitude": [1.5], "Latitude": [-2.0]})
+            frame = prepare_frame(frame, man, coordinates)
+            self.assertEqual(list(frame["coordinates_wkt"]), ["POINT (1.5 -2)"])
+            self.assertNotEqual(list(frame["coordinates"]), ["POINT (1.5 -2)"])
+
+
+class LttbTests(SimpleTestCase):
+    def test_short_series_is_kept(self):
+        x = np.arange(5.0)
+        self.assertEqual(list(lttb_indices(x, x, 10)), [0, 1, 2, 3, 4])
+
+    def test_budget_and_endpoints(self):
+        x = np.arange(1000.0)
+        y = np.sin(x / 20)
+        indices = lttb_indices(x, y, 50)
+        self.assertEqual(len(indices), 50)
+        self.assertEqual((indices[0], indices[-1]), (0, 999))
+        self.assertTrue(np.all(np.diff(indices) > 0))
+
+    def test_keeps_spike(self):
+        x = np.arange(100.0)
+        y = np.zeros(100)
+        y[37] = 10.0
+        self.assertIn(37, lttb_indices(x, y, 10))
+
+    def test_tiny_budget(self):
+        x = np.arange(10.0)
+        self.assertEqual(list(lttb_indices(x, x, 2)), [0, 9])
+
+    def test_missing_values_are_not_peaks(self):
+        x = np.arange(200.0)
+        y = np.full(200, 5.0) + np.sin(x / 10)
+        y[[20, 21, 90, 150]] = np.nan
+        indices = lttb_indices(x, y, 20)
+        self.assertEqual(len(indices), 20)
+        self.assertFalse(np.isnan(y[indices]).any())
+        self.assertEqual((indices[0], indices[-1]), (0, 199))
+
+
+def cruise_table(sizes):
+    rng = np.random.default_rng(0)
+    return pa.table(
+        {
+            "cruise": [
+                f"Cruise_{i:02d}" for i, n in enumerate(sizes) for _ in range(n)
+            ],
+            "time": np.concatenate([np.arange(n, dtype=np.int64) for n in sizes]),
+            "aod": rng.random(sum(sizes)),
+        }
+    )
+
+
+class DecimateTests(SimpleTestCase):
+    def test_budget_is_a_cap(self):
+        # More cruises than points: the smallest shares get nothing.
+        table = decimate(cruise_table([100] * 50), "aod", 20)
+        self.assertEqual(table.num_rows, 20)
+
+    def test_shared_by_size(self):
+        table = decimate(cruise_table([1000, 300, 10, 2]), "aod", 131)
+        self.assertEqual(table.num_rows, 131)
+        cruises, counts = np.unique(table["cruise"].to_numpy(), return_counts=True)
+        self.assertEqual(
+            dict(zip(cruises, counts)),
+            {"Cruise_00": 100, "Cruise_01": 30, "Cruise_02": 1},
+        )
+        first = table.filter(pc.equal(table["cruise"], "Cruise_00"))
+        self.assertEqual(first["time"][0].as_py(), 0)
+        self.assertEqual(first["time"][-1].as_py(), 999)
+
+    def test_small_table_is_kept(self):
+        table = cruise_table([5, 5])
+        self.assertIs(decimate(table, "aod", 10), table)
+
+
+def render(query):
+    # psycopg2's sql objects need a live connection for as_string().
+    if isinstance(query, sql.Composed):
+        return "".join(render(part) for part in query.seq)
+    if isinstance(query, sql.Identifier):
+        return ".".join(f'"{name}"' for name in query.strings)
+    if isinstance(query, sql.Literal):
+        return f"'{query.wrapped}'"
+    if isinstance(query, sql.SQL):
+        return query.string
+    return query
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def execute(self, query, params=None):
+        self.conn.statements.append(render(query))
+
+    def fetchall(self):
+        return self.conn.rows
+
+
+class FakeConnection:
+    """Records the statements run through it; fetchall returns rows."""
+
+    def __init__(self, rows=()):
+        self.rows = list(rows)
+        self.statements = []
+        self.commits = 0
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if exc[0] is None:
+            self.commits += 1
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+    def close(self):
+        self.closed = True
+
+
+class SwapTests(SimpleTestCase):
+    table = "maritimeapp_downloadaoddaily"
+
+    def test_finalize_rebuilds_indexes(self):
+        conn = FakeConnection(
+            [
+                (
+                    "maritimeapp_downloadaoddaily_pkey",
+                    "CREATE UNIQUE INDEX maritimeapp_downloadaoddaily_pkey ON "
+                    "public.maritimeapp_downloadaoddaily USING btree (id)",
+                    "maritimeapp_downloadaoddaily_pkey",
+                    "PRIMARY KEY (id)",
+                ),
+                (
+                    "maritimeapp_downloadaoddaily_cruise_idx",
+                    "CREATE INDEX maritimeapp_downloadaoddaily_cruise_idx ON "
+                    "public.maritimeapp_downloadaoddaily USING btree (cruise)",
+                    None,
+                    None,
+                ),
+            ]
+        )
+        renames = psql_add.Command().finalize_staging_table(conn, self.table)
+        staging = f'"{self.table}__staging"'
+        self.assertEqual(conn.statements[0], f"ALTER TABLE {staging} SET LOGGED")
+        self.assertEqual(
+            conn.statements[2:],
+            [
+                f"ALTER TABLE {staging} ADD CONSTRAINT "
+                f'"{self.table}__staging_0" PRIMARY KEY (id)',
+                f'CREATE INDEX "{self.table}__staging_1" ON {staging} '
+                "USING btree (cruise)",
+                f"ANALYZE {staging}",
+            ],
+        )
+        self.assertEqual(
+            renames,
+            [
+                (
+                    "constraint",
+                    f"{self.table}__staging_0",
+                    "maritimeapp_downloadaoddaily_pkey",
+                ),
+                (
+                    "index",
+                    f"{self.table}__staging_1",
+                    "maritimeapp_downloadaoddaily_cruise_idx",
+                ),
+            ],
+        )
+        self.assertEqual(conn.commits, 1)
+
+    def test_swap_statements(self):
+        conn = FakeConnection()
+        renames = [
+            ("constraint", "t__staging_0", "t_pkey"),
+            ("index", "t__staging_1", "t_cruise_idx"),
+        ]
+        psql_add.Command().swap_tables(conn, [("t", 1, 10, 0.1, renames)])
+        self.assertEqual(
+            conn.statements,
+            [
+                "SET LOCAL lock_timeout = '5s'",
+                'ALTER TABLE "t" RENAME TO "t__old"',
+                'ALTER TABLE "t__staging" RENAME TO "t"',
+                'DROP TABLE "t__old"',
+                'ALTER TABLE "t" RENAME CONSTRAINT "t__staging_0" TO "t_pkey"',
+                'ALTER INDEX "t__staging_1" RENAME TO "t_cruise_idx"',
+            ],
+        )
+        self.assertEqual(conn.commits, 1)
+
+    def swap_with_lock_failures(self, failures):
+        command = psql_add.Command(stdout=io.StringIO())
+        conn = FakeConnection()
+        attempts = []
+
+        def swap_tables(conn, results):
+            attempts.append(results)
+            if len(attempts) <= failures:
+                raise psycopg2.errors.LockNotAvailable("lock timeout")
+
+        command.get_db_connection = lambda: conn
+        command.swap_tables = swap_tables
+        with mock.patch.object(psql_add.time, "sleep") as sleep:
+            try:
+                command.swap_staging_tables([("t", 1, 10, 0.1, [])])
+            finally:
+                self.assertTrue(conn.closed)
+        return len(attempts), [call.args[0] for call in sleep.call_args_list]
+
+    def test_swap_retries_on_lock_timeout(self):
+        self.assertEqual(self.swap_with_lock_failures(2), (3, [1, 2]))
+
+    def test_swap_gives_up(self):
+        with self.assertRaises(psycopg2.errors.LockNotAvailable):
+            self.swap_with_lock_failures(psql_add.SWAP_ATTEMPTS)
+
+
+class ResultKeyTests(SimpleTestCase):
+    def test_open_ended_sites_key_has_today(self):
+        factory = RequestFactory()
+        open_ended = factory.get("/sites/", {"start_date": "2020-01-01"})
+        with mock.patch("maritimeapp.results.now") as now:
+            now.return_value.date.return_value = date(2024, 5, 1)
+            self.assertEqual(sites_params(open_ended)["today"], "2024-05-01")
+        bounded = factory.get(
+            "/sites/", {"start_date": "2020-01-01", "end_date": "2021-01-01"}
+        )
+        self.assertNotIn("today", sites_params(bounded))
+
+
+class ArchiveHandler(BaseHTTPRequestHandler):
+    # Stand-in for the MAN archive server, with Range/If-Range support. cut
+    # is how many bytes of the next response are sent before the connection
+    # is dropped.
+    body = b""
+    etag = '"1"'
+    cut = None
+    seen = []
+
+    def do_GET(self):
+        cls = type(self)
+        cls.seen.append(dict(self.headers))
+        match = re.fullmatch(r"bytes=(\d+)-", self.headers.get("Range", ""))
+        if_range = self.headers.get("If-Range")
+        start = 0
+        if match and (if_range is None or if_range == cls.etag):
+            start = int(match.group(1))
+            if start >= len(cls.body):
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(cls.body)}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header(
+                "Content-Range", f"bytes {start}-{len(cls.body) - 1}/{len(cls.body)}"
+            )
+        else:
+            self.send_response(200)
+        payload = cls.body[start:]
+        self.send_header("Content-Length", str(len(payload)))
+        self.send_header("ETag", cls.etag)
+        self.end_headers()
+        if cls.cut is not None:
+            payload, cls.cut = payload[: cls.cut], None
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+def man_tarball(data):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as tar:
+        for name, content in [
+            ("MAN/Cruise_1_daily.lev15", data),
+            ("MAN/README", b"not a data file"),
+        ]:
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+    return buffer.getvalue()
+
+
+class DownloadArchiveTests(SimpleTestCase):
+    def setUp(self):
+        self.data = np.random.default_rng(0).bytes(200_000)
+        self.handler = type(
+            "Handler",
+            (ArchiveHandler,),
+            {"body": man_tarball(self.data), "cut": None, "seen": []},
+        )
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_port}/archive.tar.gz"
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.folder.name, "archive.tar.gz")
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.folder.cleanup()
+
+    def interrupted_download(self):
+        self.handler.cut = len(self.handler.body) // 2
+        with self.assertRaises(requests.RequestException):
+            download_archive(self.url, self.path, chunk_size=4096)
+        self.assertFalse(os.path.exists(self.path))
+        self.assertTrue(
+            0 < os.path.getsize(self.path + ".part") < len(self.handler.body)
+        )
+
+    def test_resumes_after_drop(self):
+        self.interrupted_download()
+        self.assertTrue(download_archive(self.url, self.path, chunk_size=4096))
+        resume = self.handler.seen[-1]
+        self.assertEqual(resume["If-Range"], '"1"')
+        self.assertTrue(resume["Range"].startswith("bytes="))
+        with open(self.path, "rb") as f:
+            self.assertEqual(f.read(), self.handler.body)
+
+        dest = os.path.join(self.folder.name, "src")
+        self.assertEqual(extract_man_files(self.path, dest), 1)
+        self.assertEqual(os.listdir(dest), ["Cruise_1_daily.lev15"])
+        with open(os.path.join(dest, "Cruise_1_daily.lev15"), "rb") as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_regenerated_archive_restarts(self):
+        self.interrupted_download()
+        self.handler.body = man_tarball(self.data[::-1])
+        self.handler.etag = '"2"'
+        self.assertTrue(download_archive(self.url, self.path, chunk_size=4096))
+        with open(self.path, "rb") as f:
+            self.assertEqual(f.read(), self.handler.body)
+
+    def test_416_checks_size(self):
+        # A .part longer than the archive is not taken as complete.
+        with open(self.path + ".part", "wb") as f:
+            f.write(self.handler.body + b"junk")
+        with open(self.path + ".part.validator", "w") as f:
+            f.write('"1"')
+        self.assertTrue(download_archive(self.url, self.path))
+        with open(self.path, "rb") as f:
+            self.assertEqual(f.read(), self.handler.body)
+
+        with open(self.path + ".part", "wb") as f:
+            f.write(self.handler.body)
+        with open(self.path + ".part.validator", "w") as f:
+            f.write('"1"')
+        self.assertTrue(download_archive(self.url, self.path))
+        self.assertEqual(
+            self.handler.seen[-1]["Range"], f"bytes={len(self.handler.body)}-"
+        )
+        with open(self.path, "rb") as f:
+            self.assertEqual(f.read(), self.handler.body)
@@ -1,12 +1,28 @@
 from django.urls import include, path
 
 # from . import views
-from .views import (download_data, get_display_info, list_sites,
-                    set_csrf_token, site_measurements)
+from .views import (download_cache_stats, download_data, download_job_status,
+                    download_preflight, fetch_download_job, get_display_info,
+                    list_sites, results_cache_stats, set_csrf_token,
+                    site_measurements, submit_download_job)
 
 urlpatterns = [
     path("download/", download_data, name="download_data"),
+    path("download/preflight/", download_preflight, name="download_preflight"),
+    path("download/cache/", download_cache_stats, name="download_cache_stats"),
+    path("download/jobs/", submit_download_job, name="submit_download_job"),
+    path(
+        "download/jobs/<uuid:job_id>/",
+        download_job_status,
+        name="download_job_status",
+    ),
+    path(
+        "download/jobs/<uuid:job_id>/file/",
+        fetch_download_job,
+        name="fetch_download_job",
+    ),
     path("measurements/sites/", list_sites, name="list_sites"),
+    path("measurements/cache/", results_cache_stats, name="results_cache_stats"),
     path("measurements/", site_measurements, name="site_measurements"),
     path("display_info/", get_display_info, name="display_info"),
     path("set-csrf/", set_csrf_token, name="set-csrf"),
@@ -24,8 +24,6 @@ def set_csrf_token(request):
 
 
 import os
-import shutil
-import subprocess
 import tarfile
 import time
 from concurrent.futures import ProcessPoolExecutor
@@ -51,109 +49,52 @@ import csv
 # ----- Download #TODO: Swap to database downlaod instead of file creation
 import json
 import os
-import shutil
-import subprocess
-import tempfile
 import time as tme
 from concurrent.futures import ProcessPoolExecutor
-from datetime import date, datetime, time
+from datetime import date, time
 
 import geopandas as gpd
-import polars as pl
 import pyarrow.csv as pv
+from django.conf import settings
 from django.contrib.gis.geos import Point, Polygon
-from django.http import HttpResponse, JsonResponse
+from django.db import connection
+from django.http import (
+    FileResponse,
+    HttpResponse,
+    JsonResponse,
+    StreamingHttpResponse,
+)
+from django.urls import reverse
 from django.utils.dateparse import parse_date
 from django.utils.timezone import make_naive
 from django.views.decorators.csrf import csrf_protect
 from django.views.decorators.http import require_POST
 
+from . import jobs
+from .cache import (
+    cache_size,
+    ingest_generation,
+    lookup,
+    request_key,
+    stats as cache_stats,
+    store,
+)
+from .export import (
+    DownloadProfile,
+    archive_entries,
+    download_action,
+    download_exports,
+    download_params,
+    estimate_exports,
+    profiled,
+    stream_zip,
+)
 from .models import *
 
 
 @csrf_protect
 @require_POST
 def download_data(request):
-    aod_dict = {
-        "date_DD_MM_YYYY": "Date(dd:mm:yyyy)",
-        "time_HH_MM_SS": "Time(hh:mm:ss)",
-        "air_mass": "Air Mass",
-        "aod_340nm": "AOD_340nm",
-        "aod_380nm": "AOD_380nm",
-        "aod_440nm": "AOD_440nm",
-        "aod_500nm": "AOD_500nm",
-        "aod_675nm": "AOD_675nm",
-        "aod_870nm": "AOD_870nm",
-        "aod_1020nm": "AOD_1020nm",
-        "aod_1640nm": "AOD_1640nm",
-        "water_vapor_CM": "Water Vapor(cm)",
-        "angstrom_exponent_440_870": "440-870nm_Angstrom_Exponent",
-        "std_340nm": "STD_340nm",
-        "std_380nm": "STD_380nm",
-        "std_440nm": "STD_440nm",
-        "std_500nm": "STD_500nm",
-        "std_675nm": "STD_675nm",
-        "std_870nm": "STD_870nm",
-        "std_1020nm": "STD_1020nm",
-        "std_1640nm": "STD_1640nm",
-        "std_water_vapor_CM": "STD_Water_Vapor(cm)",
-        "std_angstrom_exponent_440_870": "STD_440-870nm_Angstrom_Exponent",
-        "number_of_observations": "Number_of_Observations",
-        "last_processing_date_DD_MM_YYYY": "Last_Processing_Date(dd:mm:yyyy)",
-        "aeronet_number": "AERONET_Number",
-        "microtops_number": "Microtops_Number",
-    }
-
-    sda_dict = {
-        "date_DD_MM_YYYY": "Date(dd:mm:yyyy)",
-        "time_HH_MM_SS": "Time(hh:mm:ss)",
-        "julian_day": "Julian_Day",
-        "air_mass": "Air_Mass",
-        "total_aod_500nm": "Total_AOD_500nm(tau_a)",
-        "fine_mode_aod_500nm": "Fine_Mode_AOD_500nm(tau_f)",
-        "coarse_mode_aod_500nm": "Coarse_Mode_AOD_500nm(tau_c)",
-        "fine_mode_fraction_500nm": "FineModeFraction_500nm(eta)",
-        "coarse_mode_fraction_500nm": "CoarseModeFraction_500nm(1_eta)",
-        "regression_dtau_a": "2nd_Order_Reg_Fit_Error_Total_AOD_500nm(regression_dtau_a)",
-        "rmse_fine_mode_aod_500nm": "RMSE_Fine_Mode_AOD_500nm(Dtau_f)",
-        "rmse_coarse_mode_aod_500nm": "RMSE_Coarse_Mode_AOD_500nm(Dtau_c)",
-        "rmse_fmf_and_cmf_fractions_500nm": "RMSE_FMF_and_CMF_Fractions_500nm(Deta)",
-        "angstrom_exponent_total_500nm": "Angstrom_Exponent(AE)_Total_500nm(alpha)",
-        "dae_dln_wavelength_total_500nm": "dAE/dln(wavelength)_Total_500nm(alphap)",
-        "ae_fine_mode_500nm": "AE_Fine_Mode_500nm(alpha_f)",
-        "dae_dln_wavelength_fine_mode_500nm": "dAE/dln(wavelength)_Fine_Mode_500nm(alphap_f)",
-        "aod_870nm": "870nm_Input_AOD",
-        "aod_675nm": "675nm_Input_AOD",
-        "aod_500nm": "500nm_Input_AOD",
-        "aod_440nm": "440nm_Input_AOD",
-        "aod_380nm": "380nm_Input_AOD",
-        "stdev_total_aod_500nm": "STDEV-Total_AOD_500nm(tau_a)",
-        "stdev_fine_mode_aod_500nm": "STDEV-Fine_Mode_AOD_500nm(tau_f)",
-        "stdev_coarse_mode_aod_500nm": "STDEV-Coarse_Mode_AOD_500nm(tau_c)",
-        "stdev_fine_mode_fraction_500nm": "STDEV-FineModeFraction_500nm(eta)",
-        "stdev_coarse_mode_fraction_500nm": "STDEV-CoarseModeFraction_500nm(1_eta)",
-        "stdev_regression_dtau_a": "STDEV-2nd_Order_Reg_Fit_Error_Total_AOD_500nm(regression_dtau_a)",
-        "stdev_rmse_fine_mode_aod_500nm": "STDEV-RMSE_Fine_Mode_AOD_500nm(Dtau_f)",
-        "stdev_rmse_coarse_mode_aod_500nm": "STDEV-RMSE_Coarse_Mode_AOD_500nm(Dtau_c)",
-        "stdev_rmse_fmf_and_cmf_fractions_500nm": "STDEV-RMSE_FMF_and_CMF_Fractions_500nm(Deta)",
-        "stdev_angstrom_exponent_total_500nm": "STDEV-Angstrom_Exponent(AE)_Total_500nm(alpha)",
-        "stdev_dae_dln_wavelength_total_500nm": "STDEV-dAE/dln(wavelength)_Total_500nm(alphap)",
-        "stdev_ae_fine_mode_500nm": "STDEV-AE_Fine_Mode_500nm(alpha_f)",
-        "stdev_dae_dln_wavelength_fine_mode_500nm": "STDEV-dAE/dln(wavelength)_Fine_Mode_500nm(alphap_f)",
-        "stdev_aod_870nm": "STDEV-870nm_Input_AOD",
-        "stdev_aod_675nm": "STDEV-675nm_Input_AOD",
-        "stdev_aod_500nm": "STDEV-500nm_Input_AOD",
-        "solar_zenith_angle": "Solar_Zenith_Angle",
-        "stdev_aod_440nm": "STDEV-440nm_Input_AOD",
-        "stdev_aod_380nm": "STDEV-380nm_Input_AOD",
-        "number_of_observations": "Number_of_Observations",
-        "last_processing_date_DD_MM_YYYY": "Last_Processing_Date(dd:mm:yyyy)",
-        "aeronet_number": "AERONET_Number",
-        "microtops_number": "Microtops_Number",
-    }
-
-    src_dir = r"./src"
-    temp_base_dir = r"./temp"
     unique_temp_folder = str(int(tme.time())) + "_MAN_DATA"
 
     try:
@@ -161,186 +102,166 @@ def download_data(request):
     except json.JSONDecodeError:
         return JsonResponse({"error": "Invalid JSON data"}, status=400)
 
-    sites = data.get("sites", [])
-    start_date = data.get("start_date", "")
-    end_date = data.get("end_date", "")
-    retrievals = data.get("retrievals", [])
-    frequency = data.get("frequency", [])
-    quality = data.get("quality", [])
-    bounds = {
-        "min_lat": data.get("min_lat", None),
-        "min_lng": data.get("min_lng", None),
-        "max_lat": data.get("max_lat", None),
-        "max_lng": data.get("max_lng", None),
-    }
-
-    if (start_date is not None) or (end_date is not None):
-        init_start_date = datetime(2004, 10, 16).strftime("%Y-%m-%d")
-        today_date = datetime.now().date().strftime("%Y-%m-%d")
-
-        if start_date is not None:
-            if start_date == init_start_date:
-                start_date = None
-        if end_date is not None:
-            if end_date == today_date:
-                end_date = None
-
-    full_temp_path = os.path.join(temp_base_dir, unique_temp_folder)
-    os.makedirs(full_temp_path, exist_ok=True)
-
-    # print(sites, retrievals, frequency, quality)
+    try:
+        params = download_params(data)
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+
+    # Queries are counted for every request, but only reported when
+    # DOWNLOAD_PROFILE is set.
+    profile = DownloadProfile(f"download {unique_temp_folder}")
+    with connection.execute_wrapper(profile):
+        response = download_response(params, unique_temp_folder, profile)
+    # A streamed archive reports once it has been sent.
+    if settings.DOWNLOAD_PROFILE and response.get("X-Cache") != "MISS":
+        profile.report()
+    return response
 
+
+def download_response(params, unique_temp_folder, profile):
     zip_filename = f"{unique_temp_folder}.zip"
-    zip_path = os.path.join(temp_base_dir, zip_filename)
-    directory_to_archive = os.path.join(temp_base_dir, unique_temp_folder)
-
-    model = None
-    filename = None
-    date_filter = Q()
-
-    if start_date:
-        date_filter &= Q(date_DD_MM_YYYY__gte=start_date)
-    if end_date:
-        date_filter &= Q(date_DD_MM_YYYY__lte=end_date)
-
-    for retrieval in retrievals:
-        for freq in frequency:
-            match (retrieval, freq):
-                case ("SDA", "Point"):
-                    model = DownloadSDAAP
-                    filename = "MAN_DATASET_SDA_POINT"
-
-                case ("SDA", "Series"):
-                    model = DownloadSDASeries
-                    filename = "MAN_DATASET_SDA_SERIES"
-
-                case ("SDA", "Daily"):
-                    model = DownloadSDADaily
-                    filename = "MAN_DATASET_SDA_DAILY"
-
-                case ("AOD", "Daily"):
-                    model = DownloadAODDaily
-                    filename = "MAN_DATASET_AOD_DAILY"
-
-                case ("AOD", "Series"):
-                    model = DownloadAODSeries
-                    filename = "MAN_DATASET_AOD_SERIES"
-
-                case ("AOD", "Point"):
-                    model = DownloadAODAP
-                    filename = "MAN_DATASET_AOD_POINT"
-
-            fieldnames = [field.name for field in model._meta.fields]
-            fieldnames.pop(0)
-            quality_map = {"Level 1.0": 10, "Level 1.5": 15, "Level 2.0": 20}
-
-            temp_fn = filename
-
-            for level in quality:
-                level_value = quality_map.get(level)
-
-                filename = temp_fn + str(level_value)
-
-                cur_header = TableHeader.objects.filter(
-                    level=quality_map[level], freq=freq, datatype=retrieval
-                ).first()
-
-                if "SDA" in retrieval:
-                    translated_cols = [
-                        sda_dict.get(header, header) for header in fieldnames
-                    ]
-                else:
-                    translated_cols = [
-                        aod_dict.get(header, header) for header in fieldnames
-                    ]
-
-                if cur_header is not None:
-                    l1_header = cur_header.base_header_l1
-                    l2_header = cur_header.base_header_l2
-                    translated_cols.remove("coordinates_wkt")
-                    header = ",".join(translated_cols)
-                    # print(header)
-                    query = model.objects.filter(cruise__in=sites, level=level_value)
-                    if date_filter:
-                        query = query.filter(date_filter)
-
-                    if all(value is not None for value in bounds.values()):
-                        min_point = Point(bounds["min_lng"], bounds["min_lat"])
-                        max_point = Point(bounds["max_lng"], bounds["max_lat"])
-                        bbox_polygon = Polygon.from_bbox(
-                            (min_point.x, min_point.y, max_point.x, max_point.y)
-                        )
-                        query = query.filter(coordinates__within=bbox_polygon)
-                    if query.exists():
-                        file_path = os.path.join(full_temp_path, filename + str(".csv"))
-
-                        with open(file_path, "w", newline="") as file:
-                            file.write(f"{l1_header}")
-                            file.write(f"{freq},** interpolated 500nm channel **\n")
-                            file.write(f"{l2_header}")
-                            file.write(f"{header}\n")
-                            file.close()
-
-                        queryset_dict = query.values(*fieldnames)
-
-                        df = pl.DataFrame(list(queryset_dict))
-                        df = df.drop("coordinates")
-                        df.write_csv(
-                            open(file_path, "a"),
-                            include_header=False,
-                            batch_size=20000,
-                        )
 
+    cache_key = request_key({**params, "generation": ingest_generation()})
+    cached = lookup(cache_key)
+    profile.stage("cache")
+    if cached is not None:
+        response = FileResponse(
+            open(cached, "rb"),
+            as_attachment=True,
+            filename=zip_filename,
+            content_type="application/zip",
+        )
+        response["X-Cache"] = "HIT"
+        return response
+
+    if settings.DOWNLOAD_DEFER_ROWS or settings.DOWNLOAD_MAX_ROWS:
+        rows = sum(
+            rows for _, rows, _ in estimate_exports(download_exports(params, ""))
+        )
+        action = download_action(rows)
+        if action == "refuse":
+            return JsonResponse(
+                {
+                    "error": f"About {rows} rows requested, more than the "
+                    f"{settings.DOWNLOAD_MAX_ROWS} allowed",
+                    "rows": rows,
+                },
+                status=413,
+            )
+        if action == "defer":
+            return job_response(jobs.submit(params))
+        profile.stage("estimate")
+
+    # The archive is built while it is sent, from the precomputed fragments
+    # when the request is unfiltered; otherwise the exports run concurrently
+    # and are added in the order they finish.
+    profile.exports, entries = archive_entries(params, unique_temp_folder)
+    profile.stage("plan")
+    chunks = store(cache_key, stream_zip(entries))
+    if settings.DOWNLOAD_PROFILE:
+        chunks = profiled(chunks, profile)
+    return StreamingHttpResponse(
+        chunks,
+        content_type="application/zip",
+        headers={
+            "Content-Disposition": f'attachment; filename="{zip_filename}"',
+            "X-Cache": "MISS",
+        },
+    )
+
+
+@require_GET
+def download_cache_stats(request):
+    return JsonResponse(
+        {
+            **cache_stats,
+            "bytes": cache_size(),
+            "budget": settings.DOWNLOAD_CACHE_BYTES,
+            "generation": ingest_generation(),
+        }
+    )
+
+
+@csrf_protect
+@require_POST
+def download_preflight(request):
     try:
-        keep_files = ["data_usage_policy.pdf", "data_usage_policy.txt"]
-        for policy_file in keep_files:
-            src_policy_file = os.path.join(src_dir, policy_file)
-            temp_policy_file = os.path.join(full_temp_path, policy_file)
+        data = json.loads(request.body.decode("utf-8"))
+    except json.JSONDecodeError:
+        return JsonResponse({"error": "Invalid JSON data"}, status=400)
 
-            os.makedirs(os.path.dirname(temp_policy_file), exist_ok=True)
+    try:
+        params = download_params(data)
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+
+    estimates = estimate_exports(download_exports(params, ""))
+    rows = sum(rows for _, rows, _ in estimates)
+    return JsonResponse(
+        {
+            "files": [
+                {"file": arcname, "rows": rows, "bytes": size}
+                for arcname, rows, size in estimates
+            ],
+            "rows": rows,
+            "bytes": sum(size for *_, size in estimates),
+            "action": download_action(rows),
+            "defer_rows": settings.DOWNLOAD_DEFER_ROWS,
+            "max_rows": settings.DOWNLOAD_MAX_ROWS,
+        }
+    )
 
-            if os.path.isfile(src_policy_file):
-                shutil.copy(src_policy_file, temp_policy_file)
-                print(f"Copied {src_policy_file} to {temp_policy_file}")
-            else:
-                print(f"Source policy file {src_policy_file} does not exist")
 
-        print("zip", "-r", "-X", zip_filename, unique_temp_folder)
-        subprocess.run(
-            ["zip", "-r", "-X", zip_filename, unique_temp_folder],
-            cwd=temp_base_dir,
-            check=True,
-        )
+def job_response(job):
+    return JsonResponse(
+        {
+            **jobs.describe(job),
+            "status_url": reverse("download_job_status", args=[job.pk]),
+            "fetch_url": reverse("fetch_download_job", args=[job.pk]),
+        },
+        status=202,
+    )
 
-        print(f"Successfully created {zip_filename} from {directory_to_archive}")
-    except subprocess.CalledProcessError as e:
-        print(f"An error occurred while creating the tar file: {e}")
-        return JsonResponse(
-            {"error": "An error occurred while creating the tar file."}, status=500
-        )
 
+@csrf_protect
+@require_POST
+def submit_download_job(request):
     try:
-        with open(zip_path, "rb") as f:
-            response = HttpResponse(
-                f.read(),
-                content_type="application/zip",
-                headers={
-                    "Content-Disposition": f'attachment; filename="{zip_filename}"'
-                },
-            )
+        data = json.loads(request.body.decode("utf-8"))
+    except json.JSONDecodeError:
+        return JsonResponse({"error": "Invalid JSON data"}, status=400)
 
-            return response
-    except Exception as e:
-        return JsonResponse({"error": str(e)}, status=500)
-    finally:
-        if os.path.exists(full_temp_path):
-            shutil.rmtree(full_temp_path)
-            print(f"Deleted temporary directory {full_temp_path}")
-        if os.path.exists(zip_path):
-            os.remove(zip_path)
-            print(f"Deleted temporary file {zip_path}")
+    try:
+        params = download_params(data)
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
 
-    return JsonResponse({"error": "Invalid request method"}, status=405)
+    return job_response(jobs.submit(params))
+
+
+@require_GET
+def download_job_status(request, job_id):
+    job = DownloadJob.objects.filter(pk=job_id).first()
+    if job is None:
+        return JsonResponse({"error": "Unknown job"}, status=404)
+    return JsonResponse(jobs.describe(job))
+
+
+@require_GET
+def fetch_download_job(request, job_id):
+    job = DownloadJob.objects.filter(pk=job_id).first()
+    if job is None:
+        return JsonResponse({"error": "Unknown job"}, status=404)
+    if job.status in (DownloadJob.QUEUED, DownloadJob.RUNNING):
+        return JsonResponse(jobs.describe(job), status=409)
+    if job.status != DownloadJob.DONE or not os.path.exists(job.path):
+        return JsonResponse(jobs.describe(job), status=410)
+    return FileResponse(
+        open(job.path, "rb"),
+        as_attachment=True,
+        filename=job.filename,
+        content_type="application/zip",
+    )
 
 
 from django.contrib.gis.geos import Point, Polygon
@@ -352,9 +273,11 @@ from django.utils.timezone import now
 from django.views.decorators.http import require_GET
 
 from .models import Site
+from .results import cached_result, measurement_params, results_stats, sites_params
 
 
 @require_GET
+@cached_result(sites_params)
 def list_sites(request):
     reading = request.GET.get("reading")
     min_lat = request.GET.get("min_lat")
@@ -434,6 +357,11 @@ from django.db import models
 from .models import DownloadAODDaily, Site
 
 
+@require_GET
+def results_cache_stats(request):
+    return JsonResponse(results_stats())
+
+
 @require_GET
 def get_display_info(request):
     returned = []
@@ -449,18 +377,45 @@ from django.http import JsonResponse
 from django.utils.dateparse import parse_date
 from django.views.decorators.http import require_GET
 
+from .measurements import (
+    ARROW_CONTENT_TYPE,
+    MEASUREMENT_FORMATS,
+    STX,
+    STY,
+    arrow_body,
+    columnar_json,
+    decimate,
+    measurement_readings,
+    measurement_table,
+    table_rows,
+)
 from .models import Site
 
 
 @csrf_protect
 @require_POST
+@cached_result(measurement_params)
 def site_measurements(request):
     try:
         data = json.loads(request.body)
     except json.JSONDecodeError:
         return JsonResponse({"error": "Invalid JSON"}, status=400)
 
-    aod_key = data.get("reading")
+    try:
+        readings = measurement_readings(data)
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    aod_key = readings[0]
+    response_format = data.get("format") or "rows"
+    if response_format not in MEASUREMENT_FORMATS:
+        return JsonResponse(
+            {"error": f"format must be one of {', '.join(MEASUREMENT_FORMATS)}"},
+            status=400,
+        )
+    try:
+        max_points = int(data.get("max_points") or 0)
+    except (TypeError, ValueError):
+        return JsonResponse({"error": "max_points must be an integer"}, status=400)
     min_lat = data.get("min_lat")
     min_lng = data.get("min_lng")
     max_lat = data.get("max_lat")
@@ -499,26 +454,49 @@ def site_measurements(request):
 
     except Exception as e:
         print(e)
+
+    # The columnar encodings, and decimation, work on Arrow arrays without a
+    # Python object per row. All readings come from the same scan.
+    if response_format != "rows" or max_points > 0:
+        table = measurement_table(queryset, readings)
+        total = table.num_rows
+        decimated = 0 < max_points < total
+        if decimated:
+            table = decimate(table, aod_key, max_points)
+
+        if response_format == "arrow":
+            response = HttpResponse(
+                arrow_body(table, readings, decimated),
+                content_type=ARROW_CONTENT_TYPE,
+            )
+        elif response_format == "columnar":
+            response = JsonResponse(columnar_json(table, readings, decimated, total))
+        else:
+            response = JsonResponse(table_rows(table, readings), safe=False)
+        response["X-Decimated"] = "true" if decimated else "false"
+        response["X-Total-Points"] = str(total)
+        return response
+
+    # Coordinates are read as ST_X/ST_Y floats; no geometry is built.
     measurements = list(
         queryset.values(
-            "cruise",
-            "date_DD_MM_YYYY",
-            "time_HH_MM_SS",
-            "coordinates",
             "aeronet_number",
-            aod_key,
+            *readings[1:],
+            site=F("cruise"),
+            date=F("date_DD_MM_YYYY"),
+            time=F("time_HH_MM_SS"),
+            value=F(aod_key),
+            lng=STX("coordinates"),
+            lat=STY("coordinates"),
         )
     )
 
     for measurement in measurements:
-        coordinates = measurement.get("coordinates")
-        if isinstance(coordinates, Point):
-            measurement["coordinates"] = {"lng": coordinates.x, "lat": coordinates.y}
-        else:
-            measurement["coordinates"] = None
-
-        measurement["value"] = measurement.pop(aod_key)
-        measurement["date"] = measurement.pop("date_DD_MM_YYYY")
-        measurement["time"] = measurement.pop("time_HH_MM_SS")
-        measurement["site"] = measurement.pop("cruise")
+        lng, lat = measurement.pop("lng"), measurement.pop("lat")
+        measurement["coordinates"] = None if lng is None else {"lng": lng, "lat": lat}
+        if len(readings) > 1:
+            measurement["values"] = {
+                reading: measurement.pop(reading, measurement["value"])
+                for reading in readings
+            }
     return JsonResponse(measurements, safe=False)
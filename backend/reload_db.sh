@@ -0,0 +1,17 @@
+#!/bin/bash
+
+# Reloads the MAN data without emptying the live tables: psql_add --swap loads
+# into staging tables and swaps them in at the end, so the site keeps serving
+# the previous data until then. Unlike reset_db.sh this keeps the schema and
+# migrations as they are.
+
+echo "reloading db"
+
+pipenv run python manage.py create_tables
+
+rm -fr ./src/
+rm -fr ./src_csvs/
+echo "starting scripts"
+pipenv run python manage.py import_dd --coordinates ewkb --wkt
+pipenv run python manage.py psql_add --binary --jobs 6 --swap
+echo "done"
@@ -2,6 +2,9 @@
 
 echo "resetting db"
 
+# The migrations below are faked and build no tables; create those of models
+# added since (ingest ledger, download jobs). flush needs them too.
+pipenv run python manage.py create_tables
 echo "yes" | pipenv run python manage.py flush
 rm ./maritimeapp/migrations/*
 pipenv run python manage.py makemigrations maritimeapp
@@ -9,7 +12,10 @@ pipenv run python manage.py migrate maritimeapp --fake
 rm -fr ./src/
 rm -fr ./src_csvs/
 echo "starting scripts"
-pipenv run python manage.py import_dd 
-pipenv run python manage.py psql_add
+# Single-pass alternative to the three steps below (no ./src_csvs, reports
+# per-table throughput):
+#   pipenv run python manage.py direct_ingest
+pipenv run python manage.py import_dd --coordinates ewkb --wkt
+pipenv run python manage.py psql_add --binary --jobs 6
 pipenv run python manage.py update_dates
 echo "done"
@@ -13,6 +13,11 @@ import API_BASE_URL from "../config";
 import ColorLegend from "./colorScale";
 import { getCookie } from "./utils/csrf";
 
+// How often a background download job is polled, and how long to wait for
+// it before giving up.
+const JOB_POLL_MS = 3000;
+const JOB_TIMEOUT_MS = 30 * 60 * 1000;
+
 export interface SiteSelect {
   name: string;
   span_date: [string, string];
@@ -233,21 +238,79 @@ const SidePanel: React.FC = () => {
       quality: Array.from(selectedQuality),
     };
 
+    const filteredParams = Object.fromEntries(
+      Object.entries(params).filter(([_, v]) => v != null),
+    );
+    const csrfToken = getCookie("X-CSRFToken");
+    const request = {
+      method: "POST",
+      headers: {
+        "Content-Type": "application/json",
+        "X-CSRFToken": csrfToken || "",
+      },
+      body: JSON.stringify(filteredParams),
+      credentials: "include" as RequestCredentials,
+    };
+
+    // Warn about (or stop) very large downloads before building them.
+    try {
+      const preflight = await fetch(
+        `${API_BASE_URL}/maritimeapp/download/preflight/`,
+        request,
+      );
+      if (preflight.ok) {
+        const estimate = await preflight.json();
+        const size = `about ${estimate.rows.toLocaleString()} rows (~${Math.ceil(
+          estimate.bytes / 1e6,
+        )} MB)`;
+        if (estimate.action === "refuse") {
+          window.alert(
+            `This download is too large (${size}). Please select fewer sites or a shorter date range.`,
+          );
+          return;
+        }
+        if (
+          estimate.action === "defer" &&
+          !window.confirm(
+            `This download is ${size} and will be prepared in the background. Continue?`,
+          )
+        ) {
+          return;
+        }
+      }
+    } catch (error) {
+      console.error("Error estimating download size:", error);
+    }
+
     setShowLoading(true); // Show the download processing indicator
     try {
-      const filteredParams = Object.fromEntries(
-        Object.entries(params).filter(([_, v]) => v != null),
+      let response = await fetch(
+        `${API_BASE_URL}/maritimeapp/download/`,
+        request,
       );
-      const csrfToken = getCookie("X-CSRFToken");
-      const response = await fetch(`${API_BASE_URL}/maritimeapp/download/`, {
-        method: "POST",
-        headers: {
-          "Content-Type": "application/json",
-          "X-CSRFToken": csrfToken || "",
-        },
-        body: JSON.stringify(filteredParams),
-        credentials: "include",
-      });
+
+      // Large downloads are handed to a background job; wait for it.
+      if (response.status === 202) {
+        const job = await response.json();
+        const deadline = Date.now() + JOB_TIMEOUT_MS;
+        let status = job.status;
+        while (status === "queued" || status === "running") {
+          if (Date.now() > deadline) {
+            throw new Error(`Download job ${job.id} did not finish in time`);
+          }
+          await new Promise((resolve) => setTimeout(resolve, JOB_POLL_MS));
+          const poll = await fetch(new URL(job.status_url, API_BASE_URL), {
+            credentials: "include",
+          });
+          if (!poll.ok) {
+            throw new Error(`HTTP error! status: ${poll.status}`);
+          }
+          status = (await poll.json()).status;
+        }
+        response = await fetch(new URL(job.fetch_url, API_BASE_URL), {
+          credentials: "include",
+        });
+      }
 
       if (!response.ok) {
         throw new Error(`HTTP error! status: ${response.status}`);
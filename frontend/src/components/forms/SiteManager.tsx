@@ -24,6 +24,40 @@ export interface Marker {
   value: number;
 }
 
+// Markers drawn at most; the server thins larger selections per cruise.
+const MAX_POINTS = 20000;
+
+// The "columnar" response of /measurements/: one array per field, with site
+// names dictionary-encoded and timestamps in epoch seconds.
+interface ColumnarMeasurements {
+  count: number;
+  decimated: boolean;
+  total: number;
+  sites: string[];
+  site: number[];
+  time: number[];
+  lng: number[];
+  lat: number[];
+  aeronet_number: number[];
+  values: { [reading: string]: (number | null)[] };
+}
+
+const toMarkers = (body: ColumnarMeasurements, reading: string): Marker[] => {
+  const values = body.values[reading];
+  return Array.from({ length: body.count }, (_, i) => {
+    const timestamp = new Date(body.time[i] * 1000).toISOString();
+    return {
+      site: body.sites[body.site[i]],
+      filename: "",
+      date: timestamp.slice(0, 10),
+      time: timestamp.slice(11, 19),
+      coordinates: { lat: body.lat[i], lng: body.lng[i] },
+      aeronet_number: body.aeronet_number[i],
+      value: values[i] ?? NaN,
+    } as unknown as Marker;
+  });
+};
+
 interface SiteManagerProps {
   startDate: string;
   endDate: string;
@@ -73,6 +107,17 @@ const SiteManager: React.FC<SiteManagerProps> = ({
   const [colors, setColors] = useState<string[]>([]);
   const [colorDomain, setColorDomain] = useState<number[]>([]);
   const [maxValue, setMaxValue] = useState<number>();
+  // The last /measurements/ response and the filters and reading it was
+  // fetched for. Only the displayed reading is requested: decimation picks
+  // points for that reading, so they would misrepresent any other.
+  const measurements = useRef<{
+    key: string;
+    body: ColumnarMeasurements;
+  } | null>(null);
+  // Map viewport the last request was narrowed to, if any. A decimated
+  // response is fetched again for the viewport whenever the map moves, so
+  // zooming in brings back full resolution.
+  const viewport = useRef<L.LatLngBounds | null>(null);
   const prevStartDate = usePrevious(startDate);
   const prevEndDate = usePrevious(endDate);
   const previousMinLat = usePrevious(minLat);
@@ -109,10 +154,30 @@ const SiteManager: React.FC<SiteManagerProps> = ({
   useEffect(() => {
     if (refreshMarkers) {
       setDomain(type);
+      // New filters start from the whole selection again.
+      viewport.current = null;
       fetchMarkers();
     }
   }, [refreshMarkers]);
 
+  // The move handler is registered once; it calls the latest fetchMarkers.
+  const fetchLatestMarkers = useRef<() => void>(() => {});
+  useEffect(() => {
+    if (map) {
+      const onMove = () => {
+        const last = measurements.current;
+        if (last && (last.body.decimated || viewport.current)) {
+          viewport.current = map.getBounds();
+          fetchLatestMarkers.current();
+        }
+      };
+      map.on("moveend", onMove);
+      return () => {
+        map.off("moveend", onMove);
+      };
+    }
+  }, [map]);
+
   useEffect(() => {
     let refresh = false;
     if (prevStartDate !== startDate || prevEndDate !== endDate) {
@@ -194,44 +259,76 @@ const SiteManager: React.FC<SiteManagerProps> = ({
       });
     }
   };
+  // The drawn selection, narrowed to the viewport when there is one.
+  const requestBounds = () => {
+    let [south, west, north, east] = [minLat, minLng, maxLat, maxLng];
+    const view = viewport.current;
+    if (view) {
+      south = Math.max(south ?? -90, view.getSouth());
+      west = Math.max(west ?? -180, view.getWest());
+      north = Math.min(north ?? 90, view.getNorth());
+      east = Math.min(east ?? 180, view.getEast());
+    }
+    return { south, west, north, east };
+  };
+
   const fetchMarkers = async () => {
     try {
+      const { south, west, north, east } = requestBounds();
       const params = {
         start_date: startDate,
         end_date: endDate,
         sites: selectedSites
           ? Array.from(selectedSites).map((site) => site)
           : [],
-        min_lat: minLat !== undefined ? minLat.toString() : null,
-        min_lng: minLng !== undefined ? minLng.toString() : null,
-        max_lat: maxLat !== undefined ? maxLat.toString() : null,
-        max_lng: maxLng !== undefined ? maxLng.toString() : null,
-        reading: type,
+        min_lat: south !== undefined ? south.toString() : null,
+        min_lng: west !== undefined ? west.toString() : null,
+        max_lat: north !== undefined ? north.toString() : null,
+        max_lng: east !== undefined ? east.toString() : null,
+        format: "columnar",
+        max_points: MAX_POINTS,
       };
 
       const filteredParams = Object.fromEntries(
         Object.entries(params).filter(([_, v]) => v != null),
       );
-      const csrfToken = getCookie("X-CSRFToken");
-      const response = await fetch(
-        `${API_BASE_URL}/maritimeapp/measurements/`,
-        {
-          method: "POST",
-          headers: {
-            "Content-Type": "application/json",
-            "X-CSRFToken": csrfToken || "",
+      const key = JSON.stringify({ ...filteredParams, reading: type });
+      let body: ColumnarMeasurements;
+      if (measurements.current && measurements.current.key === key) {
+        // Nothing changed (e.g. a marker refresh): redraw the last response.
+        body = measurements.current.body;
+      } else {
+        const csrfToken = getCookie("X-CSRFToken");
+        const response = await fetch(
+          `${API_BASE_URL}/maritimeapp/measurements/`,
+          {
+            method: "POST",
+            headers: {
+              "Content-Type": "application/json",
+              "X-CSRFToken": csrfToken || "",
+            },
+            body: JSON.stringify({
+              ...filteredParams,
+              readings: [type],
+            }),
+            credentials: "include",
           },
-          body: JSON.stringify(filteredParams),
-          credentials: "include",
-        },
-      );
+        );
 
-      if (!response.ok) {
-        clearMarkers();
-        throw new Error("Network response was not ok");
-      }
+        if (!response.ok) {
+          measurements.current = null;
+          clearMarkers();
+          throw new Error("Network response was not ok");
+        }
 
-      const data: Marker[] = await response.json();
+        body = await response.json();
+        measurements.current = { key, body };
+      }
+      if (body.decimated) {
+        // Moving the map fetches the viewport again (see onMove).
+        console.info(`Showing ${body.count} of ${body.total} measurements`);
+      }
+      const data: Marker[] = toMarkers(body, type);
 
       clearMarkers();
 
@@ -316,6 +413,8 @@ const SiteManager: React.FC<SiteManagerProps> = ({
     }
   };
 
+  fetchLatestMarkers.current = fetchMarkers;
+
   const toggleTraceActive = (active: boolean) => {
     setTraceActive(active);
   };